@@ -0,0 +1,160 @@
+import collections
+import datetime
+
+### Mergeable running aggregates used to hold query state. Every aggregate can be combined with a
+### partial aggregate of the same type computed over a different set of files, so work can be split
+### across processes and folded back together with results identical to a sequential run.
+### update_batch() takes a NumPy array holding the values of every satisfying record in a batch.
+### to_dict() returns JSON-serializable state that load() restores, for checkpoints.
+
+def _encode_value(value):
+    if isinstance(value, datetime.datetime):
+        return {'datetime': value.isoformat()}
+    return value
+
+def _decode_value(value):
+    if isinstance(value, dict) and 'datetime' in value:
+        return datetime.datetime.fromisoformat(value['datetime'])
+    return value
+
+class Count:
+    def __init__(self, value=0):
+        self.value = value
+
+    def update(self, value=None):
+        self.value += 1
+
+    def update_batch(self, values):
+        self.value += len(values)
+
+    def merge(self, other):
+        self.value += other.value
+
+    def to_dict(self):
+        return {'value': self.value}
+
+    def load(self, state):
+        self.value = state['value']
+
+class Min:
+    def __init__(self, value=None):
+        self.value = value
+
+    ### Returns True if value became the new minimum
+    def update(self, value):
+        if value is not None and (self.value is None or value < self.value):
+            self.value = value
+            return True
+        return False
+
+    def update_batch(self, values):
+        if values.dtype.kind == 'M':
+            if len(values):
+                self.update(values.min().item())
+        else:
+            for value in values.tolist():
+                self.update(value)
+
+    def merge(self, other):
+        self.update(other.value)
+
+    def to_dict(self):
+        return {'value': _encode_value(self.value)}
+
+    def load(self, state):
+        self.value = _decode_value(state['value'])
+
+class Max:
+    def __init__(self, value=None):
+        self.value = value
+
+    ### Returns True if value became the new maximum
+    def update(self, value):
+        if value is not None and (self.value is None or value > self.value):
+            self.value = value
+            return True
+        return False
+
+    def update_batch(self, values):
+        if values.dtype.kind == 'M':
+            if len(values):
+                self.update(values.max().item())
+        else:
+            for value in values.tolist():
+                self.update(value)
+
+    def merge(self, other):
+        self.update(other.value)
+
+    def to_dict(self):
+        return {'value': _encode_value(self.value)}
+
+    def load(self, state):
+        self.value = _decode_value(state['value'])
+
+### Histogram of occurrences per key. A None key is counted under missing_key.
+class GroupCount:
+    def __init__(self, missing_key=None):
+        self.counts = {}
+        self.missing_key = missing_key
+
+    def update(self, key, count=1):
+        if key is None:
+            key = self.missing_key
+        self.counts[key] = self.counts.get(key, 0) + count
+
+    def update_batch(self, values):
+        for key, count in collections.Counter(values.tolist()).items():
+            self.update(key, count)
+
+    def merge(self, other):
+        for key, count in other.counts.items():
+            self.update(key, count)
+
+    def to_dict(self):
+        return {'counts': list(self.counts.items())}
+
+    def load(self, state):
+        self.counts = dict((key, count) for key, count in state['counts'])
+
+    def keys(self):
+        return self.counts.keys()
+
+    def __len__(self):
+        return len(self.counts)
+
+### Set of distinct values that remembers the order in which values were first added
+class DistinctSet:
+    def __init__(self):
+        self.values = {}
+
+    def add(self, value):
+        self.values[value] = True
+
+    ### Adds value unless it is None
+    def update(self, value):
+        if value is not None:
+            self.values[value] = True
+
+    def update_batch(self, values):
+        for value in values.tolist():
+            self.update(value)
+
+    def merge(self, other):
+        for value in other.values:
+            self.add(value)
+
+    def to_dict(self):
+        return {'values': [_encode_value(value) for value in self.values]}
+
+    def load(self, state):
+        self.values = dict((_decode_value(value), True) for value in state['values'])
+
+    def __contains__(self, value):
+        return value in self.values
+
+    def __iter__(self):
+        return iter(self.values)
+
+    def __len__(self):
+        return len(self.values)
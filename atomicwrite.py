@@ -0,0 +1,10 @@
+import os
+
+### Writes data (str or bytes) to path by way of a temporary file in the same directory, so readers
+### (and a crash mid-write) never see a truncated file. The temporary file is named after this process,
+### so processes writing the same path at once do not interfere; the last replace wins.
+def write_atomically(path, data):
+    temporary_path = "%s.%d.tmp" % (path, os.getpid())
+    with open(temporary_path, 'wb' if isinstance(data, bytes) else 'w') as f:
+        f.write(data)
+    os.replace(temporary_path, path)
@@ -0,0 +1,89 @@
+import argparse
+import datetime
+import json
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from extract import decode_metadata_full, extract_metadata
+from ode_records import make_bsm_record, make_tim_record
+
+### Compares the metadata extraction fast path against decoding the full record, on synthetic BSM
+### and TIM lines shaped like the ODE output.
+###
+### Usage: python benchmarks/extract_benchmark.py [--records 20000] [--repeat 5]
+
+def make_lines(builder, count, seed):
+    rng = random.Random(seed)
+    lines = []
+    for _ in range(count):
+        received_at = datetime.datetime(2018, 12, 3) + datetime.timedelta(seconds=rng.uniform(0, 11000000))
+        record = builder(rng, received_at, received_at - datetime.timedelta(seconds=rng.uniform(0, 5)), log_file_name='rxMsg_%d.csv' % rng.randint(0, 500))
+        lines.append(json.dumps(record, separators=(',', ':')).encode('utf-8'))
+    return lines
+
+### Malformed and unusual records, each with whether the fast path must agree with the full decode
+### (returning the same metadata or raising as well). The others have an intact metadata block but a
+### malformed payload, which the fast path does not validate: it returns their metadata while the
+### full decode raises.
+EDGE_CASE_LINES = [
+    (b'{"metadata":{"a":1},"payload":{"x":', True),
+    (b'{"metadata":{"a":1},"payload":{"x":1}', False),
+    (b'{"metadata":{"k":{},"odeReceivedAt":"2019"},"payload":"}', False),
+    (b'{"metadata":{"a":1},"payload":{"x":1},"metadata":{"a":2}}', True),
+    (b'{"metadata":{"a":1},"metadata":{"a":2},"payload":{}}', True),
+    (b'{"metadata":{"a":1}}', True),
+    (b'{"metadata":{"a":1}}{"payload":{}}', True),
+    (b'{"metadata":{"a":1} , "payload" : {"x":1} }  ', True),
+    (b'{"metadata":{"a":{"metadata":1}},"payload":{}}', True),
+    (b'{"payload":{"x":1},"metadata":{"a":1}}', True),
+    (b'{"metadata":{"a":"\xc3\xa9"},"payload":{"x":"\xe2\x82\xac"}}', True),
+    (b'{"metadata":[1],"payload":{}}', True),
+]
+
+def decode_outcome(function, line):
+    try:
+        return function(line)
+    except ValueError as e:
+        return type(e)
+
+def best_time(function, lines, repeat):
+    best = None
+    for _ in range(repeat):
+        start_time = time.perf_counter()
+        for line in lines:
+            function(line)
+        elapsed = time.perf_counter() - start_time
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--records', type=int, default=20000)
+    parser.add_argument('--repeat', type=int, default=5)
+    args = parser.parse_args()
+
+    for line, agrees in EDGE_CASE_LINES:
+        for record in (line, line.decode('utf-8')):
+            if agrees:
+                assert decode_outcome(extract_metadata, record) == decode_outcome(decode_metadata_full, record), line
+            else:
+                assert isinstance(extract_metadata(record), dict) and decode_outcome(decode_metadata_full, record) is json.JSONDecodeError, line
+    print("Fast path behaves as documented on %d edge cases" % len(EDGE_CASE_LINES))
+
+    for record_type, builder in (('BSM', make_bsm_record), ('TIM', make_tim_record)):
+        lines = make_lines(builder, args.records, seed=1)
+        for line in lines:
+            assert extract_metadata(line) == decode_metadata_full(line)
+        average_size = sum(len(line) for line in lines) / len(lines)
+        full_time = best_time(decode_metadata_full, lines, args.repeat)
+        fast_time = best_time(extract_metadata, lines, args.repeat)
+        print("%s (%d records, %.0f bytes/record)" % (record_type, len(lines), average_size))
+        print("  full decode:  %8.0f records/sec" % (len(lines) / full_time))
+        print("  fast path:    %8.0f records/sec  (%.2fx)" % (len(lines) / fast_time, full_time / fast_time))
+
+if __name__ == "__main__":
+    main()
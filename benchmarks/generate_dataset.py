@@ -0,0 +1,53 @@
+import argparse
+import datetime
+import os
+import sys
+
+### Writes a synthetic BSM and TIM dataset in the bucket layout main.py reads locally, so the queries can
+### be run and benchmarked without downloading real data with data-download.sh.
+###
+### Usage: python benchmarks/generate_dataset.py [--root s3data] [--size-mb 512] [--file-mb 8]
+###            [--start 2018-12-01] [--end 2019-05-01] [--bsm-fraction 0.7] [--tmc-fraction 0.5]
+###            [--missing-log-file-rate 0.1] [--seed 0]
+### then point LOCAL_DATA_REPOSITORY at <root>/usdot-its-cvpilot-public-data.
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from ode_records import write_synthetic_dataset
+
+def parse_date(value):
+    return datetime.datetime.strptime(value, '%Y-%m-%d')
+
+def add_dataset_arguments(parser):
+    parser.add_argument('--size-mb', type=float, default=512, help="total size of the dataset")
+    parser.add_argument('--file-mb', type=float, default=8, help="size of each file")
+    parser.add_argument('--start', type=parse_date, default=datetime.datetime(2018, 12, 1), help="earliest odeReceivedAt (YYYY-MM-DD)")
+    parser.add_argument('--end', type=parse_date, default=datetime.datetime(2019, 5, 1), help="latest odeReceivedAt (YYYY-MM-DD, exclusive)")
+    parser.add_argument('--bsm-fraction', type=float, default=0.7, help="share of the data written as BSM rather than TIM records")
+    parser.add_argument('--tmc-fraction', type=float, default=0.5, help="share of TIM records generated by the TMC")
+    parser.add_argument('--missing-log-file-rate', type=float, default=0.1, help="share of records without a logFileName")
+    parser.add_argument('--seed', type=int, default=0)
+
+def generate(root, args):
+    return write_synthetic_dataset(
+        root,
+        int(args.size_mb*1024*1024),
+        file_bytes=int(args.file_mb*1024*1024),
+        start=args.start,
+        end=args.end,
+        bsm_fraction=args.bsm_fraction,
+        tmc_fraction=args.tmc_fraction,
+        missing_log_file_rate=args.missing_log_file_rate,
+        seed=args.seed,
+    )
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--root', default='s3data', help="directory to write the bucket directory into")
+    add_dataset_arguments(parser)
+    args = parser.parse_args()
+    totals = generate(args.root, args)
+    print("Wrote %d records in %d files (%.1f MB) under '%s'" % (totals['records'], totals['files'], totals['bytes'] / (1024*1024), args.root))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,71 @@
+import argparse
+import json
+import os
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+### Compares peak memory of the old read path (every line of a file materialized in a list) with the
+### streaming read path on a large synthetic BSM file. Each mode runs in its own subprocess so its
+### peak RSS is measured in isolation.
+###
+### Usage: python benchmarks/memory_benchmark.py [--size-mb 2048] [--path FILE] [--run-queries]
+
+def peak_rss_mb():
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak / (1024*1024) if sys.platform == 'darwin' else peak / 1024
+
+def run_child(mode, path, run_queries):
+    import main
+    from engine import QueryEngine
+    from queries import MetadataQueries
+
+    main.USE_LOCAL_DATA = True
+    start_time = time.time()
+    if mode == 'materialize':
+        with open(path, 'r') as f:
+            records = f.readlines()
+    else:
+        records = main.extract_records_from_file(None, path)
+    if run_queries:
+        engine = QueryEngine(MetadataQueries(), ['query1_totalRecordCount', 'query4_badBsmRecordCount'])
+        record_count, _ = engine.process_records(records, path)
+    else:
+        record_count = sum(1 for _ in records)
+    print(json.dumps({'mode': mode, 'records': record_count, 'seconds': round(time.time() - start_time, 3), 'peak_rss_mb': round(peak_rss_mb(), 1)}))
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--size-mb', type=int, default=2048, help="size of the synthetic file to generate")
+    parser.add_argument('--path', help="synthetic file to use (generated if it does not exist)")
+    parser.add_argument('--run-queries', action='store_true', help="also run queries over the records, not just read them")
+    parser.add_argument('--child', choices=['materialize', 'stream'], help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.child:
+        run_child(args.child, args.path, args.run_queries)
+        return
+
+    from ode_records import write_synthetic_file
+
+    path = args.path or os.path.join(tempfile.gettempdir(), 'synthetic-bsm-%dmb.json' % args.size_mb)
+    if not os.path.exists(path):
+        print("Generating %d MB synthetic file '%s'..." % (args.size_mb, path))
+        records = write_synthetic_file(path, args.size_mb*1024*1024)
+        print("Wrote %d records" % records)
+    print("File size: %.1f MB" % (os.path.getsize(path) / (1024*1024)))
+
+    for mode in ('materialize', 'stream'):
+        command = [sys.executable, os.path.abspath(__file__), '--child', mode, '--path', path]
+        if args.run_queries:
+            command.append('--run-queries')
+        output = subprocess.run(command, check=True, stdout=subprocess.PIPE, universal_newlines=True).stdout
+        result = json.loads(output.strip().splitlines()[-1])
+        print("%-12s records: %-10d time: %8.3fs   peak RSS: %8.1f MB" % (mode, result['records'], result['seconds'], result['peak_rss_mb']))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,254 @@
+import datetime
+import json
+import os
+import random
+
+### Builders for synthetic ODE records shaped like the WYDOT BSM and TIM data in the public CV pilot
+### bucket, used by the benchmarks so they can run without downloading real data.
+
+BSM_PAYLOAD_TYPE = 'us.dot.its.jpo.ode.model.OdeBsmPayload'
+TIM_PAYLOAD_TYPE = 'us.dot.its.jpo.ode.model.OdeTimPayload'
+
+def format_timestamp(value):
+    return value.strftime('%Y-%m-%dT%H:%M:%S.') + '%03dZ' % (value.microsecond // 1000)
+
+def make_bsm_record(rng, received_at, generated_at, record_generated_by='OBU', log_file_name=None):
+    metadata = {
+        'bsmSource': 'EV',
+        'logFileName': log_file_name,
+        'recordType': 'bsmTx',
+        'securityResultCode': 'success',
+        'receivedMessageDetails': {
+            'locationData': {
+                'latitude': '%.7f' % rng.uniform(41.0, 41.5),
+                'longitude': '%.7f' % rng.uniform(-110.5, -104.0),
+                'elevation': '%.1f' % rng.uniform(1800, 2400),
+                'speed': '%.2f' % rng.uniform(0, 35),
+                'heading': '%.4f' % rng.uniform(0, 360),
+            },
+            'rxSource': 'NA',
+        },
+        'payloadType': BSM_PAYLOAD_TYPE,
+        'serialId': {
+            'streamId': '%08x-%04x-%04x-%04x-%012x' % (rng.getrandbits(32), rng.getrandbits(16), rng.getrandbits(16), rng.getrandbits(16), rng.getrandbits(48)),
+            'bundleSize': 1,
+            'bundleId': rng.randint(0, 10000),
+            'recordId': 2,
+            'serialNumber': 0,
+        },
+        'odeReceivedAt': format_timestamp(received_at),
+        'schemaVersion': 6,
+        'recordGeneratedAt': format_timestamp(generated_at),
+        'recordGeneratedBy': record_generated_by,
+        'sanitized': False,
+    }
+    if log_file_name is None:
+        del metadata['logFileName']
+    payload = {
+        'dataType': 'us.dot.its.jpo.ode.plugin.j2735.J2735Bsm',
+        'data': {
+            'coreData': {
+                'msgCnt': rng.randint(0, 127),
+                'id': '%08X' % rng.getrandbits(32),
+                'secMark': rng.randint(0, 59999),
+                'position': {
+                    'latitude': round(rng.uniform(41.0, 41.5), 7),
+                    'longitude': round(rng.uniform(-110.5, -104.0), 7),
+                    'elevation': round(rng.uniform(1800, 2400), 1),
+                },
+                'accelSet': {'accelYaw': round(rng.uniform(-2, 2), 2)},
+                'accuracy': {'semiMajor': 12.7, 'semiMinor': 12.7},
+                'speed': round(rng.uniform(0, 35), 2),
+                'heading': round(rng.uniform(0, 360), 4),
+                'brakes': {
+                    'wheelBrakes': {'leftFront': False, 'rightFront': False, 'unavailable': True, 'leftRear': False, 'rightRear': False},
+                    'traction': 'unavailable',
+                    'abs': 'unavailable',
+                    'scs': 'unavailable',
+                    'brakeBoost': 'unavailable',
+                    'auxBrakes': 'unavailable',
+                },
+                'size': {'width': 244, 'length': 1828},
+            },
+            'partII': [{
+                'id': 'VehicleSafetyExtensions',
+                'value': {
+                    'pathHistory': {
+                        'crumbData': [
+                            {'elevationOffset': round(rng.uniform(-5, 5), 1), 'latOffset': round(rng.uniform(-0.001, 0.001), 7), 'lonOffset': round(rng.uniform(-0.001, 0.001), 7), 'timeOffset': round(rng.uniform(0, 60), 2)}
+                            for _ in range(rng.randint(5, 15))
+                        ],
+                    },
+                    'pathPrediction': {'confidence': 0.0, 'radiusOfCurve': 0.0},
+                },
+            }],
+        },
+    }
+    return {'metadata': metadata, 'payload': payload}
+
+def _serial_id(rng):
+    return {
+        'streamId': '%08x-%04x-%04x-%04x-%012x' % (rng.getrandbits(32), rng.getrandbits(16), rng.getrandbits(16), rng.getrandbits(16), rng.getrandbits(48)),
+        'bundleSize': 1,
+        'bundleId': rng.randint(0, 10000),
+        'recordId': 0,
+        'serialNumber': rng.randint(0, 100000),
+    }
+
+def make_tim_record(rng, received_at, generated_at, record_generated_by='TMC', log_file_name=None):
+    metadata = {
+        'request': {
+            'ode': {'version': 3, 'verb': 'POST'},
+            'sdw': None,
+            'rsus': [
+                {'rsuTarget': '10.145.%d.%d' % (rng.randint(0, 20), rng.randint(1, 254)), 'rsuUsername': 'v3user', 'rsuPassword': 'password', 'rsuRetries': 3, 'rsuTimeout': 5000, 'rsuIndex': rng.randint(1, 100)}
+                for _ in range(rng.randint(1, 4))
+            ],
+            'snmp': {'rsuid': '00000083', 'msgid': 31, 'mode': 1, 'channel': 178, 'interval': 2, 'deliverystart': format_timestamp(received_at), 'deliverystop': format_timestamp(received_at + datetime.timedelta(days=7)), 'enable': 1, 'status': 4},
+        },
+        'logFileName': log_file_name,
+        'recordGeneratedBy': record_generated_by,
+        'schemaVersion': 6,
+        'payloadType': TIM_PAYLOAD_TYPE,
+        'odePacketID': '%018X' % rng.getrandbits(72),
+        'serialId': _serial_id(rng),
+        'sanitized': False,
+        'recordGeneratedAt': format_timestamp(generated_at),
+        'maxDurationTime': 32000,
+        'odeTimStartDateTime': format_timestamp(generated_at),
+        'odeReceivedAt': format_timestamp(received_at),
+    }
+    if log_file_name is None:
+        del metadata['logFileName']
+    anchor_lat, anchor_lon = rng.uniform(41.0, 41.5), rng.uniform(-110.5, -104.0)
+    payload = {
+        'data': {
+            'MessageFrame': {
+                'messageId': 31,
+                'value': {
+                    'TravelerInformation': {
+                        'timeStamp': rng.randint(0, 527040),
+                        'packetID': '%018X' % rng.getrandbits(72),
+                        'urlB': 'null',
+                        'dataFrames': {
+                            'TravelerDataFrame': {
+                                'durationTime': 32000,
+                                'regions': {
+                                    'GeographicalPath': {
+                                        'closedPath': {'false': ''},
+                                        'anchor': {'lat': int(anchor_lat * 1e7), 'long': int(anchor_lon * 1e7)},
+                                        'name': 'I_I 80_SAT_%08X' % rng.getrandbits(32),
+                                        'laneWidth': 32700,
+                                        'directionality': {'both': ''},
+                                        'description': {
+                                            'path': {
+                                                'offset': {
+                                                    'xy': {
+                                                        'nodes': {
+                                                            'NodeXY': [
+                                                                {'delta': {'node-LatLon': {'lon': int((anchor_lon + rng.uniform(-0.05, 0.05)) * 1e7), 'lat': int((anchor_lat + rng.uniform(-0.05, 0.05)) * 1e7)}}}
+                                                                for _ in range(rng.randint(20, 60))
+                                                            ],
+                                                        },
+                                                    },
+                                                },
+                                                'scale': 0,
+                                            },
+                                        },
+                                        'direction': '0000000000010000',
+                                    },
+                                },
+                                'startYear': received_at.year,
+                                'startTime': rng.randint(0, 527040),
+                                'msgId': {'roadSignID': {'viewAngle': '1111111111111111', 'mutcdCode': {'warning': ''}, 'position': {'lat': int(anchor_lat * 1e7), 'long': int(anchor_lon * 1e7)}}},
+                                'priority': 5,
+                                'content': {'advisory': {'SEQUENCE': [{'item': {'itis': str(rng.choice([770, 1025, 2563, 4868, 5127, 8195, 13580]))}} for _ in range(rng.randint(1, 6))]}},
+                                'url': 'null',
+                                'sspTimRights': 1,
+                                'sspLocationRights': 1,
+                                'sspMsgContent': 1,
+                                'sspMsgTypes': 1,
+                                'frameType': {'advisory': ''},
+                            },
+                        },
+                        'msgCnt': rng.randint(0, 127),
+                    },
+                },
+            },
+        },
+        'dataType': 'TravelerInformation',
+    }
+    return {'metadata': metadata, 'payload': payload}
+
+### Writes BSM records received between start and end to path until the file is at least target_bytes long
+def write_synthetic_file(path, target_bytes, start=datetime.datetime(2018, 12, 3), end=datetime.datetime(2019, 4, 12), seed=0):
+    rng = random.Random(seed)
+    span = (end - start).total_seconds()
+    written = 0
+    records = 0
+    with open(path, 'w') as f:
+        while written < target_bytes:
+            received_at = start + datetime.timedelta(seconds=rng.uniform(0, span))
+            generated_at = received_at - datetime.timedelta(seconds=rng.uniform(0, 5))
+            line = json.dumps(make_bsm_record(rng, received_at, generated_at, log_file_name='bsmTx_%d.csv' % rng.randint(0, 500)), separators=(',', ':')) + '\n'
+            f.write(line)
+            written += len(line)
+            records += 1
+    return records
+
+### Writes a synthetic copy of the bucket's layout under root/<bucket>/wydot/{BSM,TIM}/YYYY/MM/DD/HH/, the
+### layout LOCAL_DATA_REPOSITORY points into. About total_bytes of records are written in files of about
+### file_bytes, spread evenly over [start, end) with each file covering a contiguous slice of time:
+###   bsm_fraction:             share of the bytes written as BSM files (the rest are TIM files)
+###   tmc_fraction:             share of TIM records generated by the TMC (the rest by RSUs)
+###   missing_log_file_rate:    share of records without a logFileName
+###   log_file_count:           number of distinct logFileName values
+### Returns {'files': n, 'records': n, 'bytes': n}. The same arguments always produce the same files.
+def write_synthetic_dataset(root, total_bytes, file_bytes=8*1024*1024, start=datetime.datetime(2018, 12, 1), end=datetime.datetime(2019, 5, 1),
+                            bsm_fraction=0.7, tmc_fraction=0.5, missing_log_file_rate=0.1, log_file_count=500, seed=0,
+                            bucket='usdot-its-cvpilot-public-data'):
+    totals = {'files': 0, 'records': 0, 'bytes': 0}
+    for record_type, type_fraction in (('BSM', bsm_fraction), ('TIM', 1 - bsm_fraction)):
+        file_count = int(round(total_bytes * type_fraction / file_bytes))
+        if file_count == 0:
+            continue
+        step = (end - start) / file_count
+        for file_number in range(file_count):
+            rng = random.Random('%s-%s-%d' % (seed, record_type, file_number))
+            file_start = start + step * file_number
+            directory = os.path.join(root, bucket, 'wydot', record_type, file_start.strftime('%Y/%m/%d/%H'))
+            os.makedirs(directory, exist_ok=True)
+            path = os.path.join(directory, 'wydot-filtered-%s-%d.json' % (record_type.lower(), file_number))
+            records, written = _write_time_slice(path, rng, record_type, file_bytes, file_start, step, tmc_fraction, missing_log_file_rate, log_file_count)
+            totals['files'] += 1
+            totals['records'] += records
+            totals['bytes'] += written
+    return totals
+
+def _write_time_slice(path, rng, record_type, target_bytes, start, span, tmc_fraction, missing_log_file_rate, log_file_count):
+    records = []
+    written = 0
+    while written < target_bytes:
+        if rng.random() < missing_log_file_rate:
+            log_file_name = None
+        else:
+            log_file_name = '%sTx_%d.csv' % (record_type.lower(), rng.randrange(log_file_count))
+        if record_type == 'BSM':
+            record = make_bsm_record(rng, start, start, log_file_name=log_file_name)
+        else:
+            record = make_tim_record(rng, start, start, 'TMC' if rng.random() < tmc_fraction else 'RSU', log_file_name)
+        records.append(record)
+        written += len(json.dumps(record, separators=(',', ':'))) + 1
+    # Timestamps are assigned once the number of records in the slice is known, so they increase
+    # through the file as they do in real data (timestamps all format to the same length)
+    offsets = sorted(rng.uniform(0, span.total_seconds()) for _ in records)
+    with open(path, 'w') as f:
+        for record, offset in zip(records, offsets):
+            received_at = start + datetime.timedelta(seconds=offset)
+            generated_at = received_at - datetime.timedelta(seconds=rng.uniform(0, 5 if record_type == 'BSM' else 3600))
+            record['metadata']['odeReceivedAt'] = format_timestamp(received_at)
+            record['metadata']['recordGeneratedAt'] = format_timestamp(generated_at)
+            if record_type == 'TIM':
+                record['metadata']['odeTimStartDateTime'] = format_timestamp(generated_at)
+            f.write(json.dumps(record, separators=(',', ':')) + '\n')
+    return len(records), written
@@ -0,0 +1,167 @@
+import argparse
+import contextlib
+import json
+import os
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+### Measures records/sec, MB/sec and peak RSS of perform_query for each query (and all queries
+### together) in each execution mode, over a synthetic dataset generated on first use. Every run is
+### a separate subprocess so its peak RSS is measured in isolation. Modes that rely on state from an
+### earlier run (cached, zone_maps) get an unmeasured warm-up run first.
+###
+### Results can be saved and later compared against, to catch regressions:
+###   python benchmarks/query_benchmark.py --save baseline.json
+###   python benchmarks/query_benchmark.py --compare baseline.json
+###
+### Usage: python benchmarks/query_benchmark.py [--data DIR] [--size-mb 128] [--modes baseline,parallel]
+###            [--queries query1_totalRecordCount,all] [--save FILE] [--compare FILE] [--tolerance 0.1]
+###        plus the dataset options of generate_dataset.py
+
+ALL_QUERIES = 'all'
+
+### Settings each mode applies to main.py, on top of its defaults. 'baseline' is the plain sequential,
+### row-at-a-time path the other modes are compared against.
+MODES = {
+    'baseline': {'PARALLEL_WORKERS': 1, 'VECTORIZED_BATCH_SIZE': 0},
+    'vectorized': {'PARALLEL_WORKERS': 1, 'VECTORIZED_BATCH_SIZE': 10000},
+    'parallel': {'PARALLEL_WORKERS': None, 'VECTORIZED_BATCH_SIZE': 0},
+    'cached': {'PARALLEL_WORKERS': 1, 'VECTORIZED_BATCH_SIZE': 0, 'METADATA_CACHE_DIRECTORY': '{work}/cache'},
+    'zone_maps': {'PARALLEL_WORKERS': 1, 'VECTORIZED_BATCH_SIZE': 0, 'ZONE_MAP_PATH': '{work}/zone_maps.json'},
+    'fan_out': {'PARALLEL_WORKERS': 1, 'VECTORIZED_BATCH_SIZE': 0, 'FAN_OUT_EXECUTOR': 'multiprocessing'},
+}
+WARM_UP_MODES = ('cached', 'zone_maps')
+
+def peak_rss_mb():
+    # Worker processes (parallel and fan-out modes) are children; the peak of any one process is reported
+    peak = max(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss, resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss)
+    return peak / (1024*1024) if sys.platform == 'darwin' else peak / 1024
+
+def run_child(data, mode, query_names, work):
+    import fanout
+    import main
+    from queries import MetadataQueries
+
+    main.USE_LOCAL_DATA = True
+    main.LOCAL_DATA_REPOSITORY = data
+    main.PROGRESS_INTERVAL_SECONDS = float('inf')
+    for name, value in MODES[mode].items():
+        setattr(main, name, value.format(work=work) if isinstance(value, str) else value)
+    query_object = MetadataQueries()
+    if query_names == [ALL_QUERIES]:
+        query_names = list(query_object.queries)
+
+    with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+        listings = main.list_s3_objects_for_prefixes(None, main.PREFIX_STRINGS)
+        s3_object_list = [s3_object for prefix in main.PREFIX_STRINGS for s3_object in listings[prefix]]
+        start_time = time.time()
+        if main.FAN_OUT_EXECUTOR is not None:
+            main.FAN_OUT_SHARD_BYTES = -(-sum(s3_object.size for s3_object in s3_object_list) // (os.cpu_count() or 1))
+            results = main.perform_fanned_out_query(s3_object_list, query_object, query_names, fanout.MultiprocessingExecutor(main.lambda_handler))
+        else:
+            versions = dict((s3_object.key, s3_object.version) for s3_object in s3_object_list)
+            sizes = dict((s3_object.key, s3_object.size) for s3_object in s3_object_list)
+            results = main.perform_query(None, [s3_object.key for s3_object in s3_object_list], query_object, query_names, versions=versions, sizes=sizes)
+        seconds = time.time() - start_time
+    result = next(iter(results.values()))
+    print(json.dumps({
+        'records': result.records_satisfying + result.records_not_satisfying,
+        'bytes': sum(s3_object.size for s3_object in s3_object_list),
+        'seconds': round(seconds, 3),
+        'peak_rss_mb': round(peak_rss_mb(), 1),
+    }))
+
+def run_measurement(data, mode, query_name, work):
+    command = [sys.executable, os.path.abspath(__file__), '--child', mode, '--data', data, '--queries', query_name, '--work', work]
+    # Written files (invalid_*.txt) go to the work directory
+    output = subprocess.run(command, check=True, stdout=subprocess.PIPE, universal_newlines=True, cwd=work).stdout
+    return json.loads(output.strip().splitlines()[-1])
+
+def main():
+    from generate_dataset import add_dataset_arguments, generate
+    from queries import QUERY_DEFINITIONS
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--data', help="bucket directory to query (a synthetic dataset is generated if it does not exist)")
+    parser.add_argument('--modes', default=','.join(MODES), help="comma-separated execution modes (%s)" % ", ".join(MODES))
+    parser.add_argument('--queries', default=','.join(list(QUERY_DEFINITIONS) + [ALL_QUERIES]), help="comma-separated query names, '%s' for all queries in one pass" % ALL_QUERIES)
+    parser.add_argument('--save', help="file to save the results to")
+    parser.add_argument('--compare', help="results saved by an earlier run to compare against")
+    parser.add_argument('--tolerance', type=float, default=0.1, help="slowdown in records/sec reported as a regression")
+    parser.add_argument('--child', choices=list(MODES), help=argparse.SUPPRESS)
+    parser.add_argument('--work', help=argparse.SUPPRESS)
+    add_dataset_arguments(parser)
+    parser.set_defaults(size_mb=128)
+    args = parser.parse_args()
+
+    if args.child:
+        run_child(args.data, args.child, args.queries.split(','), args.work)
+        return
+
+    data = args.data or os.path.join(tempfile.gettempdir(), 'synthetic-s3data-%gmb-seed%d' % (args.size_mb, args.seed), 'usdot-its-cvpilot-public-data')
+    if not os.path.exists(data):
+        print("Generating %g MB synthetic dataset under '%s'..." % (args.size_mb, os.path.dirname(data)))
+        totals = generate(os.path.dirname(data), args)
+        print("Wrote %d records in %d files" % (totals['records'], totals['files']))
+    data = os.path.abspath(data)
+
+    modes = args.modes.split(',')
+    if 'vectorized' in modes:
+        import vectorized
+        if not vectorized.available():
+            print("Skipping mode 'vectorized': numpy is not installed")
+            modes.remove('vectorized')
+
+    previous = {}
+    if args.compare:
+        with open(args.compare, 'r') as f:
+            previous = dict(((result['mode'], result['query']), result) for result in json.load(f))
+
+    print("%-10s %-32s %10s %9s %12s %9s %10s %s" % ('mode', 'query', 'records', 'seconds', 'records/s', 'MB/s', 'peak RSS', 'vs. saved' if previous else ''))
+    results = []
+    regressions = []
+    for mode in modes:
+        for query_name in args.queries.split(','):
+            work = tempfile.mkdtemp(prefix='query-benchmark-')
+            try:
+                if mode in WARM_UP_MODES:
+                    run_measurement(data, mode, query_name, work)
+                measurement = run_measurement(data, mode, query_name, work)
+            finally:
+                shutil.rmtree(work)
+            result = {
+                'mode': mode,
+                'query': query_name,
+                'records': measurement['records'],
+                'seconds': measurement['seconds'],
+                'records_per_second': round(measurement['records'] / max(measurement['seconds'], 1e-9), 1),
+                'megabytes_per_second': round(measurement['bytes'] / (1024*1024) / max(measurement['seconds'], 1e-9), 2),
+                'peak_rss_mb': measurement['peak_rss_mb'],
+            }
+            results.append(result)
+            comparison = ''
+            if (mode, query_name) in previous:
+                ratio = result['records_per_second'] / previous[(mode, query_name)]['records_per_second']
+                comparison = "%.2fx" % ratio
+                if ratio < 1 - args.tolerance:
+                    comparison += " REGRESSION"
+                    regressions.append((mode, query_name, ratio))
+            print("%-10s %-32s %10d %9.3f %12.0f %9.2f %7.1f MB %s" % (mode, query_name, result['records'], result['seconds'], result['records_per_second'], result['megabytes_per_second'], result['peak_rss_mb'], comparison))
+
+    if args.save:
+        with open(args.save, 'w') as f:
+            json.dump(results, f, indent=2)
+        print("Results saved to '%s'" % args.save)
+    if regressions:
+        print("%d measurements regressed by more than %d%%" % (len(regressions), args.tolerance * 100))
+        sys.exit(1)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,165 @@
+import array
+import hashlib
+import json
+import os
+import struct
+import zlib
+from atomicwrite import write_atomically
+
+### Persistent on-disk cache of extracted record metadata. Each source object is stored as one compact
+### columnar file holding only the metadata fields queries use, so repeat queries over immutable
+### historical data read a small file instead of downloading and decoding the original JSON.
+###
+### Entries are stored per object key and named after the object's version (S3 ETag, or size and mtime
+### for local files), so a changed object never matches its stale entry; the stale entry is removed when
+### the new one is written. Total cache size is bounded by evicting the least recently used entries.
+### A cache is opened once per run and handed to worker processes, which continue from its size as
+### measured when it was opened; processes writing at the same time can together exceed the bound
+### until the next eviction rescans the cache.
+###
+### File layout (zlib-compressed after the magic bytes): a 4-byte header length, a JSON header with
+### the key, version, record count and each field's dictionary of distinct values, then each field's
+### dictionary codes as a packed array.
+
+CACHED_FIELDS = ('odeReceivedAt', 'recordGeneratedAt', 'recordGeneratedBy', 'payloadType', 'logFileName')
+
+_MAGIC = b'MQC1'
+_SUFFIX = '.cols'
+
+### Collects the cached fields of every metadata dict passing through collect(), so a file's columns
+### can be written to the cache while its records are being queried
+class ColumnCollector:
+    def __init__(self, fields=CACHED_FIELDS):
+        self.columns = {field: [] for field in fields}
+        self.record_count = 0
+
+    def collect(self, metadata_iterable):
+        columns = list(self.columns.items())
+        for metadata in metadata_iterable:
+            for field, values in columns:
+                values.append(metadata.get(field))
+            self.record_count += 1
+            yield metadata
+
+class MetadataCache:
+    def __init__(self, directory, max_bytes, fields=CACHED_FIELDS):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.fields = tuple(fields)
+        os.makedirs(directory, exist_ok=True)
+        self.total_bytes = sum(size for _, size, _ in self._entries())
+
+    ### Every version of an object is stored in a directory named after the object's key
+    def _key_directory(self, key):
+        return os.path.join(self.directory, hashlib.sha1(key.encode('utf-8')).hexdigest())
+
+    def _path(self, key, version):
+        return os.path.join(self._key_directory(key), hashlib.sha1(str(version).encode('utf-8')).hexdigest()[:16] + _SUFFIX)
+
+    ### Returns (mtime, size, path) for every cache file
+    def _entries(self):
+        entries = []
+        for key_entry in os.scandir(self.directory):
+            if key_entry.is_dir():
+                for entry in os.scandir(key_entry.path):
+                    if entry.name.endswith(_SUFFIX):
+                        stat = entry.stat()
+                        entries.append((stat.st_mtime, stat.st_size, entry.path))
+        return entries
+
+    ### Returns True if the cache can answer queries that need the given fields
+    def covers(self, fields):
+        return set(fields) <= set(self.fields)
+
+    def contains(self, key, version):
+        return os.path.exists(self._path(key, version))
+
+    ### Returns ({field: [values]}, record_count) for the given object version, or None on a miss
+    def get(self, key, version):
+        path = self._path(key, version)
+        try:
+            with open(path, 'rb') as f:
+                data = f.read()
+        except FileNotFoundError:
+            return None
+        try:
+            columns, record_count = _decode(data, key, version)
+        except Exception as e:
+            print("WARNING: Discarding unreadable cache entry for '%s': %s" % (key, str(e)))
+            self._remove(path)
+            return None
+        # Reads count as use for eviction
+        os.utime(path)
+        return columns, record_count
+
+    ### Stores the given object version's columns, unless the entry would not fit in the cache at all
+    def put(self, key, version, columns, record_count):
+        path = self._path(key, version)
+        data = _encode(key, version, {field: columns[field] for field in self.fields}, record_count)
+        if len(data) > self.max_bytes:
+            return
+        key_directory = self._key_directory(key)
+        if os.path.isdir(key_directory):
+            for entry in os.scandir(key_directory):
+                if entry.name.endswith(_SUFFIX) and entry.path != path:
+                    self._remove(entry.path) # stale version of a changed object
+        os.makedirs(key_directory, exist_ok=True)
+        if os.path.exists(path):
+            self.total_bytes -= os.path.getsize(path)
+        write_atomically(path, data)
+        self.total_bytes += len(data)
+        if self.total_bytes > self.max_bytes:
+            self._evict(keep=path)
+
+    def _remove(self, path):
+        try:
+            size = os.path.getsize(path)
+            os.remove(path)
+            self.total_bytes -= size
+        except FileNotFoundError:
+            pass # already removed by another process sharing the cache
+        try:
+            os.rmdir(os.path.dirname(path))
+        except OSError:
+            pass # other versions (or a concurrent write) still present
+
+    ### Removes least recently used entries until the cache fits within max_bytes
+    def _evict(self, keep):
+        entries = self._entries()
+        self.total_bytes = sum(size for _, size, _ in entries)
+        for _, _, path in sorted(entries):
+            if self.total_bytes <= self.max_bytes:
+                break
+            if path != keep:
+                self._remove(path)
+
+def _encode(key, version, columns, record_count):
+    header = {'key': key, 'version': version, 'records': record_count, 'fields': []}
+    packed_codes = []
+    for field, values in columns.items():
+        dictionary = {}
+        codes = [dictionary.setdefault(value, len(dictionary)) for value in values]
+        typecode = 'B' if len(dictionary) <= 0xFF else 'H' if len(dictionary) <= 0xFFFF else 'I'
+        header['fields'].append({'name': field, 'values': list(dictionary), 'typecode': typecode})
+        packed_codes.append(array.array(typecode, codes).tobytes())
+    header_bytes = json.dumps(header, separators=(',', ':')).encode('utf-8')
+    return _MAGIC + zlib.compress(struct.pack('<I', len(header_bytes)) + header_bytes + b''.join(packed_codes), 1)
+
+def _decode(data, key, version):
+    if not data.startswith(_MAGIC):
+        raise ValueError("not a metadata cache file")
+    payload = zlib.decompress(data[len(_MAGIC):])
+    header_length = struct.unpack_from('<I', payload)[0]
+    header = json.loads(payload[4:4+header_length])
+    if header['key'] != key or header['version'] != version:
+        raise ValueError("cache entry belongs to a different object")
+    offset = 4 + header_length
+    columns = {}
+    for field in header['fields']:
+        codes = array.array(field['typecode'])
+        length = codes.itemsize * header['records']
+        codes.frombytes(payload[offset:offset+length])
+        offset += length
+        values = field['values']
+        columns[field['name']] = [values[code] for code in codes]
+    return columns, header['records']
@@ -0,0 +1,40 @@
+import json
+from atomicwrite import write_atomically
+from botocore.exceptions import ClientError
+from urllib.parse import urlparse
+
+### Persistent snapshot of a query run: the selected queries, every file already processed (with the
+### version it was processed at), the serialized query results so far and whether the run finished.
+### Stored either as a local JSON file or, for Lambda where local storage does not outlive the
+### invocation, as an S3 object given as 's3://bucket/key'.
+class Checkpoint:
+    def __init__(self, location, s3_client=None):
+        self.location = location
+        self.s3_client = s3_client
+        parsed = urlparse(location)
+        self.s3_bucket = parsed.netloc if parsed.scheme == 's3' else None
+        self.s3_key = parsed.path.lstrip('/') if parsed.scheme == 's3' else None
+
+    ### Returns the saved state, or None if no checkpoint exists yet
+    def load(self):
+        if self.s3_bucket is not None:
+            try:
+                body = self.s3_client.get_object(Bucket=self.s3_bucket, Key=self.s3_key)['Body'].read()
+            except ClientError as e:
+                if e.response['Error']['Code'] in ('NoSuchKey', '404'):
+                    return None
+                raise
+            return json.loads(body)
+        try:
+            with open(self.location, 'r') as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return None
+
+    def save(self, queries, processed, results, complete):
+        state = {'queries': queries, 'complete': complete, 'processed': processed, 'results': results}
+        data = json.dumps(state, separators=(',', ':'))
+        if self.s3_bucket is not None:
+            self.s3_client.put_object(Bucket=self.s3_bucket, Key=self.s3_key, Body=data.encode('utf-8'))
+            return
+        write_atomically(self.location, data)
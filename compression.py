@@ -0,0 +1,89 @@
+import bz2
+import gzip
+import io
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+### Transparent compression for objects being read and files being written. Compressed objects are
+### recognized by their extension (.gz, .bz2, .zst) or, failing that, by their leading magic bytes,
+### and are decompressed as they are read, so only the read buffer (never the whole decompressed
+### object) is held in memory. zstd support requires the zstandard package.
+
+GZIP = 'gzip'
+BZIP2 = 'bz2'
+ZSTD = 'zstd'
+
+EXTENSIONS = {GZIP: '.gz', BZIP2: '.bz2', ZSTD: '.zst'}
+
+_MAGIC_BYTES = ((GZIP, b'\x1f\x8b'), (BZIP2, b'BZh'), (ZSTD, b'\x28\xb5\x2f\xfd'))
+
+def compression_from_name(name):
+    for compression, extension in EXTENSIONS.items():
+        if name.endswith(extension):
+            return compression
+    return None
+
+### Returns a binary stream of the decompressed contents of stream, or stream itself if it is not
+### compressed. name (a filename or key) is used to recognize the compression by extension.
+def decompressing_stream(stream, name):
+    compression = compression_from_name(name)
+    if compression is None:
+        # No recognized extension: look for magic bytes, handing the bytes read back to the reader
+        head = stream.read(4)
+        stream = _PrefixedStream(head, stream)
+        compression = next((compression for compression, magic in _MAGIC_BYTES if head.startswith(magic)), None)
+        if compression is None:
+            return stream
+    if compression == GZIP:
+        return gzip.GzipFile(fileobj=stream, mode='rb')
+    if compression == BZIP2:
+        return bz2.BZ2File(stream, mode='rb')
+    if zstandard is None:
+        raise RuntimeError("Cannot read zstd-compressed '%s': the zstandard package is not installed" % name)
+    return zstandard.ZstdDecompressor().stream_reader(stream, read_across_frames=True)
+
+### Opens path for writing text, compressed with the given compression (None for plain text). The
+### compression's extension is appended to path. Returns (file object, path written).
+def open_text_output(path, compression=None):
+    if compression is None:
+        return open(path, 'w'), path
+    if compression not in EXTENSIONS:
+        raise ValueError("Unknown output compression '%s'" % compression)
+    path += EXTENSIONS[compression]
+    if compression == GZIP:
+        return gzip.open(path, 'wt', encoding='utf-8'), path
+    if compression == BZIP2:
+        return bz2.open(path, 'wt', encoding='utf-8'), path
+    if zstandard is None:
+        raise RuntimeError("Cannot write zstd-compressed '%s': the zstandard package is not installed" % path)
+    return io.TextIOWrapper(zstandard.ZstdCompressor().stream_writer(open(path, 'wb')), encoding='utf-8'), path
+
+### Binary stream that returns prefix before the rest of stream
+class _PrefixedStream(io.RawIOBase):
+    def __init__(self, prefix, stream):
+        self.prefix = prefix
+        self.stream = stream
+
+    def readable(self):
+        return True
+
+    def read(self, size=-1):
+        if not self.prefix:
+            return self.stream.read(size)
+        if size is None or size < 0:
+            data = self.prefix + self.stream.read()
+            self.prefix = b''
+            return data
+        data = self.prefix[:size]
+        self.prefix = self.prefix[size:]
+        if len(data) < size:
+            data += self.stream.read(size - len(data))
+        return data
+
+    def readinto(self, buffer):
+        data = self.read(len(buffer))
+        buffer[:len(data)] = data
+        return len(data)
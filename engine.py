@@ -0,0 +1,256 @@
+import time
+import vectorized
+import zonemap
+from aggregates import Count, DistinctSet
+from extract import extract_metadata
+from metrics import RunMetrics
+from queries import extract_row
+
+### Outcome of a single query over a run: how many records did and did not satisfy it, which files
+### contained at least one satisfying record (in the order they were first seen), and the query's
+### aggregate over the satisfying records.
+class QueryResult:
+    def __init__(self, aggregate):
+        self.records_satisfying = 0
+        self.records_not_satisfying = 0
+        self.satisfying_files = DistinctSet()
+        self.aggregate = aggregate
+
+    def merge(self, other):
+        self.records_satisfying += other.records_satisfying
+        self.records_not_satisfying += other.records_not_satisfying
+        self.satisfying_files.merge(other.satisfying_files)
+        self.aggregate.merge(other.aggregate)
+
+    def to_dict(self):
+        return {
+            'records_satisfying': self.records_satisfying,
+            'records_not_satisfying': self.records_not_satisfying,
+            'satisfying_files': list(self.satisfying_files),
+            'aggregate': self.aggregate.to_dict(),
+        }
+
+    def load(self, state):
+        self.records_satisfying = state['records_satisfying']
+        self.records_not_satisfying = state['records_not_satisfying']
+        self.satisfying_files = DistinctSet()
+        for filename in state['satisfying_files']:
+            self.satisfying_files.add(filename)
+        self.aggregate.load(state['aggregate'])
+
+### Evaluates any number of compiled metadata queries in a single pass over the data. Each record is
+### decoded once (stopping after its metadata block where possible), the fields needed by the selected
+### queries are extracted (and timestamps parsed) once, and the resulting row is handed to every
+### selected query. With a batch_size, records are instead evaluated in chunks as NumPy columns.
+### Counters and stage timings of the work done are kept in metrics (see metrics.RunMetrics).
+class QueryEngine:
+    def __init__(self, query_object, query_names, batch_size=0, stage_timing=False):
+        self.query_object = query_object
+        self.query_names = list(query_names)
+        self.results = {}
+        for query_name in self.query_names:
+            if query_name not in query_object.queries:
+                raise ValueError("Unknown metadata query '%s'" % query_name)
+            self.results[query_name] = QueryResult(query_object.queries[query_name].new_aggregate())
+        self.fields, self.timestamp_fields = query_object.required_fields(self.query_names)
+        if batch_size and not vectorized.available():
+            print("WARNING: numpy is not installed, evaluating queries one record at a time")
+            batch_size = 0
+        self.batch_size = batch_size
+        self.metrics = RunMetrics(stage_timing)
+        self._batch_predicates = None
+
+    # Generated predicates cannot be pickled; they are recompiled on first use after unpickling
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['_batch_predicates'] = None
+        return state
+
+    ### Returns an engine running the same queries with empty state, for processing a subset of the
+    ### files whose results are later folded back in with merge()
+    def partial(self):
+        return QueryEngine(self.query_object, self.query_names, self.batch_size, self.metrics.stage_timing)
+
+    def merge(self, other):
+        for query_name in self.query_names:
+            self.results[query_name].merge(other.results[query_name])
+        self.metrics.merge(other.metrics)
+
+    ### JSON-serializable state of every query's results
+    def state_dict(self):
+        return {query_name: self.results[query_name].to_dict() for query_name in self.query_names}
+
+    def load_state(self, state):
+        for query_name in self.query_names:
+            self.results[query_name].load(state[query_name])
+
+    ### Runs every selected query over the records of one file. Returns the number of records read
+    ### and a {query_name: records_satisfying} dict for this file only.
+    def process_records(self, records, filename):
+        if self.metrics.stage_timing:
+            return self.process_metadata(self.metrics.timed_map('decode', extract_metadata, records), filename)
+        return self.process_metadata(map(extract_metadata, records), filename)
+
+    ### Same as process_records, for records whose metadata blocks have already been decoded
+    def process_metadata(self, metadata_iterable, filename):
+        satisfying = [0] * len(self.query_names)
+        record_count = 0
+        if self.batch_size:
+            batch = []
+            for metadata in metadata_iterable:
+                batch.append(metadata)
+                if len(batch) == self.batch_size:
+                    record_count += len(batch)
+                    self._evaluate_columns(self._columns_from_metadata(batch), len(batch), satisfying)
+                    batch = []
+            if batch:
+                record_count += len(batch)
+                self._evaluate_columns(self._columns_from_metadata(batch), len(batch), satisfying)
+        else:
+            record_count = self._evaluate_rows(metadata_iterable, satisfying)
+        return self._record_file_results(filename, record_count, satisfying)
+
+    ### Same as process_records, for a file already extracted into {field: [value per record]} columns
+    ### (e.g. from the metadata cache). The columns must include every field the queries need.
+    def process_columns(self, columns, record_count, filename):
+        satisfying = [0] * len(self.query_names)
+        needed_fields = self.fields + self.timestamp_fields
+        if self.batch_size:
+            for start in range(0, record_count, self.batch_size):
+                batch_columns = {field: columns[field][start:start+self.batch_size] for field in needed_fields}
+                self._evaluate_columns(batch_columns, min(self.batch_size, record_count - start), satisfying)
+        else:
+            self._evaluate_rows(_rows_from_columns({field: columns[field] for field in needed_fields}, record_count), satisfying)
+        self.metrics.counters['files_from_cache'] += 1
+        return self._record_file_results(filename, record_count, satisfying)
+
+    ### Returns the per-query satisfying counts for a file determined from its zone map alone, or None
+    ### if some query needs the file's records (because only some of them can match, or because its
+    ### aggregate needs their values)
+    def satisfying_from_stats(self, stats):
+        satisfying = []
+        for query_name in self.query_names:
+            query = self.query_object.queries[query_name]
+            match = zonemap.classify(query, stats)
+            if match == zonemap.MATCHES_NONE:
+                satisfying.append(0)
+            elif match == zonemap.MATCHES_ALL and query.aggregate_type == 'count':
+                satisfying.append(stats['records'])
+            else:
+                return None
+        return satisfying
+
+    ### Records the results of a file answered from its zone map (see satisfying_from_stats)
+    def process_stats_answer(self, satisfying, record_count, filename):
+        for query_name, query_satisfying in zip(self.query_names, satisfying):
+            if query_satisfying:
+                self.results[query_name].aggregate.merge(Count(query_satisfying))
+        self.metrics.counters['files_from_zone_maps'] += 1
+        return self._record_file_results(filename, record_count, satisfying)
+
+    def _record_file_results(self, filename, record_count, satisfying):
+        self.metrics.counters['files'] += 1
+        self.metrics.counters['records'] += record_count
+        file_satisfying = {}
+        for query_name, query_satisfying in zip(self.query_names, satisfying):
+            result = self.results[query_name]
+            result.records_satisfying += query_satisfying
+            result.records_not_satisfying += record_count - query_satisfying
+            if query_satisfying:
+                result.satisfying_files.add(filename)
+            file_satisfying[query_name] = query_satisfying
+        return record_count, file_satisfying
+
+    ### Evaluates metadata dicts one at a time, adding each query's satisfying count to satisfying.
+    ### Returns the number of records evaluated.
+    def _evaluate_rows(self, metadata_iterable, satisfying):
+        if self.metrics.stage_timing:
+            return self._evaluate_rows_timed(metadata_iterable, satisfying)
+        queries = []
+        for query_name in self.query_names:
+            query = self.query_object.queries[query_name]
+            queries.append((query.predicate, query.aggregate_field, self.results[query_name].aggregate))
+        fields = self.fields
+        timestamp_fields = self.timestamp_fields
+        record_count = 0
+        for metadata in metadata_iterable:
+            record_count += 1
+            row = extract_row(metadata, fields, timestamp_fields)
+            for i, (predicate, aggregate_field, aggregate) in enumerate(queries):
+                if predicate(row):
+                    satisfying[i] += 1
+                    aggregate.update(row[aggregate_field] if aggregate_field else None)
+        return record_count
+
+    ### Same as _evaluate_rows, timing each stage of the evaluation into metrics
+    def _evaluate_rows_timed(self, metadata_iterable, satisfying):
+        queries = []
+        for query_name in self.query_names:
+            query = self.query_object.queries[query_name]
+            queries.append((query.predicate, query.aggregate_field, self.results[query_name].aggregate))
+        fields = self.fields
+        timestamp_fields = self.timestamp_fields
+        clock = time.perf_counter
+        parse_seconds = predicate_seconds = aggregate_seconds = 0.0
+        record_count = 0
+        for metadata in metadata_iterable:
+            record_count += 1
+            start = clock()
+            row = extract_row(metadata, fields, timestamp_fields)
+            parsed = clock()
+            parse_seconds += parsed - start
+            for i, (predicate, aggregate_field, aggregate) in enumerate(queries):
+                start = clock()
+                matched = predicate(row)
+                evaluated = clock()
+                predicate_seconds += evaluated - start
+                if matched:
+                    satisfying[i] += 1
+                    aggregate.update(row[aggregate_field] if aggregate_field else None)
+                    aggregate_seconds += clock() - evaluated
+        seconds = self.metrics.seconds
+        seconds['timestamp_parse'] += parse_seconds
+        seconds['predicate'] += predicate_seconds
+        seconds['aggregate'] += aggregate_seconds
+        return record_count
+
+    def _columns_from_metadata(self, metadata_batch):
+        columns = {}
+        for field in self.fields + self.timestamp_fields:
+            columns[field] = [metadata.get(field) for metadata in metadata_batch]
+        return columns
+
+    ### Evaluates a chunk of records held as {field: [values]} using NumPy columns. Chunks whose
+    ### timestamps cannot be converted in bulk are evaluated row by row instead.
+    def _evaluate_columns(self, columns, record_count, satisfying):
+        # Timing a whole batch at a time is cheap enough to do whenever stage timing is enabled
+        clock = time.perf_counter if self.metrics.stage_timing else None
+        start = clock() if clock else 0
+        arrays = vectorized.build_columns(columns, self.fields, self.timestamp_fields)
+        if clock:
+            self.metrics.seconds['timestamp_parse'] += clock() - start
+        if arrays is None:
+            self._evaluate_rows(_rows_from_columns(columns, record_count), satisfying)
+            return
+        if self._batch_predicates is None:
+            self._batch_predicates = [vectorized.compile_batch_predicate(self.query_object.queries[query_name]) for query_name in self.query_names]
+        for i, query_name in enumerate(self.query_names):
+            start = clock() if clock else 0
+            mask = self._batch_predicates[i](arrays, record_count)
+            matched = int(mask.sum())
+            if clock:
+                evaluated = clock()
+                self.metrics.seconds['predicate'] += evaluated - start
+            if matched:
+                satisfying[i] += matched
+                aggregate_field = self.query_object.queries[query_name].aggregate_field
+                self.results[query_name].aggregate.update_batch(arrays[aggregate_field][mask] if aggregate_field else mask[mask])
+                if clock:
+                    self.metrics.seconds['aggregate'] += clock() - evaluated
+
+### Turns {field: [values]} columns back into one {field: value} dict per record
+def _rows_from_columns(columns, record_count):
+    if not columns:
+        return ({} for _ in range(record_count))
+    fields = list(columns)
+    return (dict(zip(fields, values)) for values in zip(*[columns[field] for field in fields]))
@@ -0,0 +1,51 @@
+import json
+import re
+
+### Fast extraction of the 'metadata' block of an ODE record. ODE writes each record as
+### {"metadata":{...},"payload":{...}} with the (small) metadata object first and the (large) payload
+### after it, so decoding can stop as soon as the metadata object closes: only a prefix of the line is
+### decoded from UTF-8 and parsed, and the payload is never touched. Records that do not fit that
+### layout fall back to decoding the full record: the metadata object must be followed by the payload
+### key (or close the record), the record's last non-blank character must be '}', and no second
+### metadata key may appear later in the record (json.loads keeps the last duplicate key).
+###
+### The payload itself is not validated, since that would cost as much as decoding it. A record whose
+### metadata block is intact but whose payload is malformed - including a record truncated just after
+### a '}' - yields its metadata here where the full decode would raise.
+
+### Bytes of a record decoded and parsed on the fast path. Metadata blocks are typically around 1KB;
+### records whose metadata does not fit within the prefix are retried with a full decode.
+METADATA_PREFIX_BYTES = 4096
+
+### Characters at the end of a record searched for its closing '}'; records with more trailing
+### whitespace than this take the full decode
+TAIL_CHECK_LENGTH = 64
+
+_METADATA_KEY = re.compile(r'\s*\{\s*"metadata"\s*:\s*', re.ASCII)
+_AFTER_METADATA = re.compile(r'\s*(?:,\s*"payload"\s*:|\}\s*\Z)', re.ASCII)
+_decoder = json.JSONDecoder()
+
+### Reference path: decodes the whole record
+def decode_metadata_full(record):
+    return json.loads(record)['metadata']
+
+def extract_metadata(record):
+    try:
+        if isinstance(record, bytes):
+            text = record[:METADATA_PREFIX_BYTES].decode('utf-8')
+            metadata_key, record_end = b'"metadata"', b'}'
+        else:
+            text = record[:METADATA_PREFIX_BYTES]
+            metadata_key, record_end = '"metadata"', '}'
+        key_match = _METADATA_KEY.match(text)
+        if key_match is not None:
+            metadata, end = _decoder.raw_decode(text, key_match.end())
+            # The key match is ASCII, so its end is the same offset in bytes and in text. Only the
+            # record's tail is stripped, so checking its end does not copy the whole record.
+            if (isinstance(metadata, dict) and _AFTER_METADATA.match(text, end)
+                    and record[-TAIL_CHECK_LENGTH:].rstrip().endswith(record_end)
+                    and record.find(metadata_key, key_match.end()) < 0):
+                return metadata
+    except ValueError: # covers both JSONDecodeError and UnicodeDecodeError
+        pass
+    return decode_metadata_full(record)
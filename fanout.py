@@ -0,0 +1,132 @@
+import boto3
+import collections
+import json
+import multiprocessing
+import traceback
+from botocore.config import Config
+from concurrent.futures import ThreadPoolExecutor
+
+### Fan-out/fan-in support for splitting one query run across many invocations. A coordinator splits
+### the listed objects into shards, an executor runs a worker event per shard, and each worker returns
+### the serialized partial state of its queries, which the coordinator merges in shard order.
+###
+### Executors share one interface: map(events) returns one response per event, in the order of events.
+### Events and responses are JSON-serializable dicts, as they must be for Lambda invocations.
+
+### Splits objects (anything with a size attribute) into contiguous shards of at most max_bytes each.
+### An object larger than max_bytes gets a shard of its own. Returns a list of lists of objects.
+def make_shards(objects, max_bytes):
+    shards = []
+    shard = []
+    shard_bytes = 0
+    for item in objects:
+        if shard and shard_bytes + item.size > max_bytes:
+            shards.append(shard)
+            shard = []
+            shard_bytes = 0
+        shard.append(item)
+        shard_bytes += item.size
+    if shard:
+        shards.append(shard)
+    return shards
+
+### Runs every event through handler in this process, one after another. Useful for local testing.
+class InProcessExecutor:
+    def __init__(self, handler):
+        self.handler = handler
+
+    def map(self, events):
+        # Round-tripped through JSON so responses look exactly like those of a Lambda invocation
+        return [json.loads(json.dumps(self.handler(json.loads(json.dumps(event)), None))) for event in events]
+
+### Runs each event through handler in its own process, at most `processes` at a time
+class MultiprocessingExecutor:
+    def __init__(self, handler, processes=None):
+        self.handler = handler
+        self.processes = processes or multiprocessing.cpu_count()
+
+    def map(self, events):
+        return run_in_processes(self.handler, [(event, None) for event in events], self.processes)
+
+### Calls function(*arguments) in a process of its own for each tuple in argument_list, at most
+### `processes` at a time, and returns the results in the order of argument_list. Processes
+### communicate over pipes rather than a multiprocessing.Pool, which is unavailable on AWS Lambda.
+### If function raises (or exits, as the query code does on unparseable timestamps) or a process dies
+### without returning its result, the processes still running are terminated and a RuntimeError
+### describing the failure is raised.
+def run_in_processes(function, argument_list, processes):
+    results = []
+    running = collections.deque()
+    try:
+        for arguments in argument_list:
+            if len(running) >= processes:
+                results.append(_receive(*running.popleft()))
+            parent_connection, child_connection = multiprocessing.Pipe(duplex=False)
+            process = multiprocessing.Process(target=_send_result, args=(child_connection, function, arguments))
+            process.start()
+            child_connection.close()
+            running.append((process, parent_connection))
+        while running:
+            results.append(_receive(*running.popleft()))
+    except BaseException:
+        for process, _ in running:
+            process.terminate()
+        for process, connection in running:
+            process.join()
+            connection.close()
+        raise
+    return results
+
+### Sent back in place of a result by a process whose function failed
+class _WorkerFailure:
+    def __init__(self, description):
+        self.description = description
+
+def _receive(process, connection):
+    try:
+        result = connection.recv()
+    except EOFError:
+        process.join()
+        raise RuntimeError("Worker process exited with code %s before returning its result" % process.exitcode)
+    finally:
+        connection.close()
+    process.join()
+    if isinstance(result, _WorkerFailure):
+        raise RuntimeError("Worker process failed:\n%s" % result.description)
+    return result
+
+def _send_result(connection, function, arguments):
+    try:
+        result = function(*arguments)
+    except BaseException as e: # including SystemExit
+        result = _WorkerFailure("".join(traceback.format_exception(type(e), e, e.__traceback__)).rstrip())
+    connection.send(result)
+    connection.close()
+
+### Invokes a Lambda function synchronously once per event, up to `concurrency` invocations at a time.
+### Each invocation may run up to Lambda's 15 minute limit, so the client's read timeout is raised to
+### match and retries are disabled (a retried invocation would process its shard twice).
+class LambdaExecutor:
+    def __init__(self, function_name, concurrency=100, lambda_client=None):
+        self.function_name = function_name
+        self.concurrency = concurrency
+        self.lambda_client = lambda_client or boto3.client('lambda', config=Config(
+            read_timeout=960,
+            retries={'max_attempts': 0},
+            max_pool_connections=concurrency,
+        ))
+
+    def _invoke(self, event):
+        response = self.lambda_client.invoke(
+            FunctionName=self.function_name,
+            InvocationType='RequestResponse',
+            Payload=json.dumps(event).encode('utf-8'),
+        )
+        payload = json.loads(response['Payload'].read())
+        if response.get('FunctionError'):
+            raise RuntimeError("Worker invocation of '%s' failed: %s" % (self.function_name, payload.get('errorMessage', payload)))
+        return payload
+
+    def map(self, events):
+        with ThreadPoolExecutor(max_workers=self.concurrency) as executor:
+            return list(executor.map(self._invoke, events))
@@ -0,0 +1,188 @@
+import boto3
+import collections
+import hashlib
+import io
+import os
+import threading
+from botocore.config import Config
+from botocore.exceptions import ClientError
+from botocore.response import StreamingBody
+from concurrent.futures import ThreadPoolExecutor
+
+### A listed object: its key, size in bytes and version (S3 ETag, or size and mtime for local files)
+ObjectInfo = collections.namedtuple('ObjectInfo', ['key', 'size', 'version'])
+
+### Returns an S3 client whose connection pool is large enough to be shared by `max_pool_connections`
+### concurrent downloader threads (boto3 clients are thread-safe; the default pool only holds 10)
+def create_s3_client(max_pool_connections=10):
+    return boto3.client('s3', config=Config(max_pool_connections=max_pool_connections))
+
+### Limits the number of downloaded-but-not-yet-processed bytes. Reservations are granted strictly in
+### file order so a later object can never hold the budget an earlier one is waiting for. A single
+### object larger than the whole budget is still admitted once nothing else is in flight.
+class _ByteBudget:
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.in_flight = 0
+        self.next_ticket = 0
+        self.closed = False
+        self.condition = threading.Condition()
+
+    ### Returns False if the budget was closed while waiting
+    def acquire(self, ticket, size):
+        with self.condition:
+            while not self.closed and (ticket != self.next_ticket or (self.in_flight > 0 and self.in_flight + size > self.max_bytes)):
+                self.condition.wait()
+            if self.closed:
+                return False
+            self.in_flight += size
+            self.next_ticket += 1
+            self.condition.notify_all()
+            return True
+
+    def release(self, size):
+        with self.condition:
+            self.in_flight -= size
+            self.condition.notify_all()
+
+    def close(self):
+        with self.condition:
+            self.closed = True
+            self.condition.notify_all()
+
+### Downloads S3 objects ahead of the consumer on a bounded pool of threads sharing one client, so
+### the network stays busy while the current object is being queried. At most `prefetch_count`
+### objects are requested ahead of the one being processed, and at most `max_in_flight_bytes` of
+### downloaded bodies are held in memory at any time. An object's size is reserved against the budget
+### before it is requested, so downloads waiting for the budget hold no open responses; sizes are
+### taken from `sizes` ({key: size}, e.g. from the listing) or looked up with a HEAD request. Objects
+### larger than the whole budget are not buffered at all; their response body is handed over to be
+### streamed by the consumer.
+###
+### Iterating yields (key, stream) tuples in the order of `keys`, where stream is a readable binary
+### file-like object. A buffered object's bytes count against the budget until the consumer asks
+### for the next object.
+class S3Prefetcher:
+    def __init__(self, s3_client, bucket, keys, prefetch_count=4, concurrency=4, max_in_flight_bytes=256*1024*1024, sizes=None):
+        self.s3_client = s3_client
+        self.bucket = bucket
+        self.keys = list(keys)
+        self.sizes = sizes or {}
+        self.prefetch_count = max(prefetch_count, 1)
+        self.concurrency = max(concurrency, 1)
+        self.budget = _ByteBudget(max_in_flight_bytes)
+
+    def _download(self, ticket, key):
+        size = self.sizes.get(key)
+        if size is None:
+            size = self.s3_client.head_object(Bucket=self.bucket, Key=key)['ContentLength']
+        if size > self.budget.max_bytes:
+            size = 0
+        if not self.budget.acquire(ticket, size):
+            return None, 0
+        try:
+            response = self.s3_client.get_object(Bucket=self.bucket, Key=key)
+        except Exception:
+            self.budget.release(size)
+            raise
+        if size == 0:
+            return response['Body'], 0
+        try:
+            return io.BytesIO(response['Body'].read()), size
+        except Exception:
+            self.budget.release(size)
+            raise
+        finally:
+            response['Body'].close()
+
+    def __iter__(self):
+        pending = collections.deque()
+        next_index = 0
+        executor = ThreadPoolExecutor(max_workers=self.concurrency)
+        try:
+            while next_index < len(self.keys) or pending:
+                while next_index < len(self.keys) and len(pending) <= self.prefetch_count:
+                    pending.append((self.keys[next_index], executor.submit(self._download, next_index, self.keys[next_index])))
+                    next_index += 1
+                key, future = pending.popleft()
+                stream, size = future.result()
+                try:
+                    yield key, stream
+                finally:
+                    stream.close()
+                    self.budget.release(size)
+        finally:
+            self.budget.close()
+            for _, future in pending:
+                future.cancel()
+            executor.shutdown(wait=True)
+            for _, future in pending:
+                if not future.cancelled() and future.exception() is None:
+                    stream, size = future.result()
+                    if stream is not None:
+                        stream.close()
+                        self.budget.release(size)
+
+### Minimal stand-in for a boto3 S3 client that serves objects from a local directory laid out as
+### <root>/<bucket>/<key>. Supports the calls this project makes (get_object, head_object and
+### list_objects_v2, plus put_object), which is enough to exercise the S3 code paths without network
+### access. Missing keys raise the same ClientError as S3 does.
+class LocalS3Client:
+    def __init__(self, root):
+        self.root = root
+
+    def _path(self, bucket, key, operation_name='GetObject'):
+        path = os.path.join(self.root, bucket, key)
+        if operation_name != 'PutObject' and not os.path.isfile(path):
+            raise ClientError({'Error': {'Code': 'NoSuchKey', 'Message': 'The specified key does not exist.', 'Key': key}}, operation_name)
+        return path
+
+    def _etag(self, path):
+        stat = os.stat(path)
+        return '"%s"' % hashlib.md5(("%d-%d" % (stat.st_size, stat.st_mtime_ns)).encode()).hexdigest()
+
+    def head_object(self, Bucket, Key):
+        path = self._path(Bucket, Key, 'HeadObject')
+        return {'ContentLength': os.path.getsize(path), 'ETag': self._etag(path)}
+
+    def get_object(self, Bucket, Key):
+        path = self._path(Bucket, Key)
+        size = os.path.getsize(path)
+        return {'Body': StreamingBody(open(path, 'rb'), size), 'ContentLength': size, 'ETag': self._etag(path)}
+
+    def put_object(self, Bucket, Key, Body):
+        path = self._path(Bucket, Key, 'PutObject')
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, 'wb') as f:
+            f.write(Body)
+        return {'ETag': self._etag(path)}
+
+    def list_objects_v2(self, Bucket, Prefix='', Delimiter=None, ContinuationToken=None, MaxKeys=1000):
+        bucket_root = os.path.join(self.root, Bucket)
+        # Keys and common prefixes are paginated together, in key order, as S3 does
+        items = set()
+        for directory, _, filenames in os.walk(bucket_root):
+            for filename in filenames:
+                key = os.path.relpath(os.path.join(directory, filename), bucket_root).replace(os.sep, '/')
+                if key.startswith(Prefix):
+                    delimiter_index = key.find(Delimiter, len(Prefix)) if Delimiter else -1
+                    items.add((key, False) if delimiter_index < 0 else (key[:delimiter_index+len(Delimiter)], True))
+        items = sorted(items)
+        start = int(ContinuationToken) if ContinuationToken else 0
+        page = items[start:start+MaxKeys]
+        response = {'KeyCount': len(page)}
+        contents = []
+        common_prefixes = []
+        for item, is_common_prefix in page:
+            if is_common_prefix:
+                common_prefixes.append({'Prefix': item})
+            else:
+                head = self.head_object(Bucket, item)
+                contents.append({'Key': item, 'Size': head['ContentLength'], 'ETag': head['ETag']})
+        if contents:
+            response['Contents'] = contents
+        if common_prefixes:
+            response['CommonPrefixes'] = common_prefixes
+        if start + MaxKeys < len(items):
+            response['NextContinuationToken'] = str(start + MaxKeys)
+        return response
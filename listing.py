@@ -0,0 +1,124 @@
+import datetime
+import json
+import os
+import zonemap
+from atomicwrite import write_atomically
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from fetch import ObjectInfo
+
+### Object listing. S3 prefixes are listed concurrently: each prefix is split along its directory
+### levels (one delimited list request per level) until the sub-prefixes cover a single day of the
+### bucket's YYYY/MM/DD/HH layout, and every day is then listed in full on its own thread. Pagination
+### within one sub-prefix is inherently serial, so splitting is what lets listing run in parallel.
+### Local directories are listed with a single os.scandir walk.
+###
+### Every listing keeps each object's size and version and is returned sorted by key, the order S3
+### lists keys in.
+
+### Maximum number of directory levels a prefix is split into below itself
+MAX_SPLIT_DEPTH = 4
+
+### Version of a local file: changes whenever the file's size or modification time changes
+def local_file_version(stat):
+    return "%d-%d" % (stat.st_size, stat.st_mtime_ns)
+
+### Returns an ObjectInfo for every file below root/prefix, with paths as keys. Hidden files are
+### skipped.
+def walk_local_prefix(root, prefix):
+    objects = []
+    directories = [root + "/" + prefix.rstrip("/")]
+    while directories:
+        try:
+            entries = os.scandir(directories.pop())
+        except (FileNotFoundError, NotADirectoryError):
+            continue
+        with entries:
+            for entry in entries:
+                if entry.name.startswith('.'):
+                    continue
+                if entry.is_dir():
+                    directories.append(entry.path)
+                elif entry.is_file():
+                    stat = entry.stat()
+                    objects.append(ObjectInfo(entry.path, stat.st_size, local_file_version(stat)))
+    objects.sort(key=lambda s3_object: s3_object.key)
+    return objects
+
+### Returns {prefix: [ObjectInfo]} for every object under each of the given prefixes, which are
+### treated as directories (a trailing '/' is implied)
+def list_s3_prefixes(s3_client, bucket, prefixes, concurrency=16):
+    listings = {prefix: [] for prefix in prefixes}
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        pending = {}
+        def submit(prefix, sub_prefix, depth):
+            split = depth < MAX_SPLIT_DEPTH and not _is_single_day(sub_prefix)
+            future = executor.submit(_list_pages, s3_client, bucket, sub_prefix, '/' if split else None)
+            pending[future] = (prefix, depth)
+        for prefix in prefixes:
+            submit(prefix, prefix.rstrip('/') + '/', 0)
+        while pending:
+            done, _ = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                prefix, depth = pending.pop(future)
+                objects, common_prefixes = future.result()
+                listings[prefix].extend(objects)
+                for common_prefix in common_prefixes:
+                    submit(prefix, common_prefix, depth + 1)
+    for objects in listings.values():
+        objects.sort(key=lambda s3_object: s3_object.key)
+    return listings
+
+def _is_single_day(prefix):
+    time_range = zonemap.prefix_time_range(prefix)
+    return time_range is not None and time_range[1] - time_range[0] <= datetime.timedelta(days=1)
+
+### Follows every page of a list request, returning (objects, common prefixes)
+def _list_pages(s3_client, bucket, prefix, delimiter=None):
+    arguments = {'Bucket': bucket, 'Prefix': prefix}
+    if delimiter:
+        arguments['Delimiter'] = delimiter
+    objects = []
+    common_prefixes = []
+    while True:
+        response = s3_client.list_objects_v2(**arguments)
+        for item in response.get('Contents', []):
+            objects.append(ObjectInfo(item['Key'], item['Size'], item['ETag']))
+        for item in response.get('CommonPrefixes', []):
+            common_prefixes.append(item['Prefix'])
+        if not response.get('NextContinuationToken'):
+            return objects, common_prefixes
+        arguments['ContinuationToken'] = response['NextContinuationToken']
+
+### Returns (added, changed, removed) keys between two listings of the same prefix
+def diff_listings(old_objects, new_objects):
+    old_versions = dict((s3_object.key, s3_object.version) for s3_object in old_objects)
+    new_versions = dict((s3_object.key, s3_object.version) for s3_object in new_objects)
+    added = [key for key in new_versions if key not in old_versions]
+    changed = [key for key in new_versions if key in old_versions and old_versions[key] != new_versions[key]]
+    removed = [key for key in old_versions if key not in new_versions]
+    return added, changed, removed
+
+### Listings of earlier runs, saved as a JSON file keyed by prefix. Each entry records where it was
+### listed from (a local directory or an S3 bucket) and when, so later runs can reuse recent listings
+### instead of listing again, or diff a fresh listing against the previous one.
+class ListingManifest:
+    def __init__(self, path):
+        self.path = path
+        try:
+            with open(path, 'r') as f:
+                self.entries = json.load(f)
+        except FileNotFoundError:
+            self.entries = {}
+
+    ### Returns (listed_at, [ObjectInfo]) for prefix as listed from source, or None if there is none
+    def get(self, prefix, source):
+        entry = self.entries.get(prefix)
+        if entry is None or entry['source'] != source:
+            return None
+        return datetime.datetime.fromisoformat(entry['listed_at']), [ObjectInfo(*item) for item in entry['objects']]
+
+    def put(self, prefix, source, objects, listed_at):
+        self.entries[prefix] = {'source': source, 'listed_at': listed_at.isoformat(), 'objects': [list(s3_object) for s3_object in objects]}
+
+    def save(self):
+        write_atomically(self.path, json.dumps(self.entries, separators=(',', ':')))
@@ -1,152 +1,536 @@
-import boto3
+import datetime
 import dateutil
-import glob
+import fanout
 import json
+import listing
 import logging
+import metrics
 import os
 import queue
 import time
+import zonemap
+from cache import ColumnCollector, MetadataCache
+from checkpoint import Checkpoint
+from compression import open_text_output
+from concurrent.futures import ThreadPoolExecutor
+from engine import QueryEngine
+from extract import extract_metadata
+from fetch import LocalS3Client, S3Prefetcher, create_s3_client
 from queries import MetadataQueries
+from records import iter_local_file_records, iter_s3_object_records, iter_stream_records
 
 USE_LOCAL_DATA = True # whether to load data from S3 (false) or locally (true)
 LOCAL_DATA_REPOSITORY = "s3data/usdot-its-cvpilot-public-data" # path to local directory containing s3 data
+LOCAL_S3_ROOT = None # with USE_LOCAL_DATA False, serve S3 requests from this directory (laid out as <root>/<bucket>/<key>) instead of S3, to exercise the S3 code paths offline (None to use S3)
 
-### Query to run
-METADATA_QUERY = 'query13_listOfLogFilesBefore'
+### Queries to run. All of them are evaluated in a single pass over the data.
+METADATA_QUERIES = ['query13_listOfLogFilesBefore']
+
+### Number of worker processes to split the file list across (None to use every available core, 1 to run sequentially)
+PARALLEL_WORKERS = 1
+
+### Number of records evaluated together as NumPy arrays (0 to evaluate one record at a time). Requires numpy.
+VECTORIZED_BATCH_SIZE = 0
 
 ### Data source configuration settings
 PREFIX_STRINGS = ["wydot/BSM/2018/12", "wydot/BSM/2019/01", "wydot/BSM/2019/02", "wydot/BSM/2019/03", "wydot/BSM/2019/04", "wydot/TIM/2018/12", "wydot/TIM/2019/01", "wydot/TIM/2019/02", "wydot/TIM/2019/03", "wydot/TIM/2019/04"]
 S3_BUCKET = "usdot-its-cvpilot-public-data"
 
+### Compression of the file lists written at the end of a run: 'gzip', 'bz2' or 'zstd' (requires zstandard), or None for
+### plain text. The compression's extension is appended to the file names.
+OUTPUT_COMPRESSION = None
+
+### Progress and metrics reporting. Metrics (files, records, bytes read, throughput and time per stage) are printed as JSON
+### at the end of every run.
+PROGRESS_INTERVAL_SECONDS = 10 # minimum time between progress lines
+STAGE_TIMING = False # also time decoding, timestamp parsing, predicates and aggregates (adds per-record overhead; fetch time is always measured)
+METRICS_PATH = None # JSON file the metrics are also written to (None to only print them)
+PROFILE_OUTPUT_PATH = None # file to save cProfile stats of the run to (None to disable profiling); worker processes are not profiled
+
+### Object listing. Each prefix is listed concurrently, split into one listing per day sub-prefix.
+### A reused listing's versions are trusted until it expires: objects changed since then are still looked up by their old
+### version in the metadata cache, zone maps and checkpoint, so those may serve results of the old contents. Objects
+### added since are not queried at all. Keep the maximum age short (or the manifest disabled) if objects are rewritten.
+LISTING_CONCURRENCY = 16 # number of concurrent S3 list requests
+LISTING_MANIFEST_PATH = None # JSON file listings are saved to, so later runs can reuse or diff them (None to always list)
+LISTING_MANIFEST_MAX_AGE = datetime.timedelta(hours=24) # saved listings older than this are listed again and diffed against the manifest
+
+### S3 download settings (only used when USE_LOCAL_DATA is False)
+S3_PREFETCH_COUNT = 4 # number of objects downloaded ahead of the one being queried (0 to download one object at a time)
+S3_DOWNLOAD_CONCURRENCY = 4 # number of downloader (and version lookup) threads, all sharing one pooled S3 client with the listing threads
+S3_MAX_IN_FLIGHT_BYTES = 256*1024*1024 # upper bound on downloaded object bytes held in memory awaiting processing; larger objects are streamed
+
+### Objects ending in .gz, .bz2 or .zst (or starting with those formats' magic bytes) are decompressed as they are read.
+### Size of the buffer files and objects are read through. Records are streamed, so this (rather than the size of the largest file) bounds memory use.
+READ_BUFFER_SIZE = 1024*1024
+
+### Persistent metadata cache. Files whose current version (S3 ETag, or size and mtime locally) is cached are read from
+### compact columnar cache files instead of being downloaded and decoded. Files being cached have their metadata columns
+### held in memory while they are processed.
+METADATA_CACHE_DIRECTORY = None # directory holding the cache (None to disable caching)
+METADATA_CACHE_MAX_BYTES = 1024*1024*1024 # least recently used entries are evicted beyond this size
+
+### Per-file zone maps (record count, odeReceivedAt range, distinct payloadType and recordGeneratedBy values). Files whose
+### zone map shows that no selected query needs their records are not read; count queries are answered from it directly.
+ZONE_MAP_PATH = None # JSON file holding the zone maps (None to disable)
+
+### Skip listing prefixes whose YYYY/MM[/DD] layout lies entirely outside every selected query's odeReceivedAt window.
+### Records under skipped prefixes are not counted as records not satisfying the queries.
+PARTITION_PRUNING = True
+PARTITION_PRUNING_SLACK = datetime.timedelta(days=1) # allowance for records filed under a neighbouring date
+
+### Checkpointing. The query results so far and every file processed (with its version) are saved periodically, so a run
+### that crashes or times out loses little work. Files that changed after being processed are reported but not reprocessed,
+### since their earlier contribution cannot be taken back out of the results.
+CHECKPOINT_LOCATION = None # local JSON file or 's3://bucket/key' (None to disable checkpointing)
+CHECKPOINT_MODE = 'resume' # 'resume' continues an unfinished run and starts over after a finished one; 'incremental' always processes only files missing from the checkpoint, merging them into its results
+CHECKPOINT_INTERVAL_SECONDS = 60 # minimum time between checkpoint writes (one is always written at the end)
+CHECKPOINT_TIME_RESERVE_SECONDS = 30 # on Lambda, stop and checkpoint once less than this remains before the invocation times out
+CHECKPOINT_FILES_PER_ROUND = 16 # with PARALLEL_WORKERS, files are handed out in rounds of this many per worker and checkpointed between rounds
+
+### Fan-out mode. The invocation acting as coordinator lists the objects, splits them into shards of about FAN_OUT_SHARD_BYTES,
+### hands one shard to each worker and merges the workers' partial results, so no single invocation has to read everything.
+### Workers are invocations of lambda_handler with a {'mode': 'worker'} event. Checkpointing is not used in fan-out mode.
+FAN_OUT_EXECUTOR = None # 'lambda' to invoke worker Lambdas, 'multiprocessing' or 'in_process' to run workers locally (None to run everything in one invocation)
+FAN_OUT_SHARD_BYTES = 4*1024*1024*1024 # total object size per worker; keep it small enough for a worker to finish well within the Lambda timeout
+FAN_OUT_CONCURRENCY = 100 # maximum number of workers running at once
+FAN_OUT_LAMBDA_FUNCTION = None # function invoked for workers (None to invoke the coordinator's own function)
+
 def lambda_handler(event, context):
 
     if USE_LOCAL_DATA:
         print("NOTE: Using local data in directory '%s'" % LOCAL_DATA_REPOSITORY)
+    elif LOCAL_S3_ROOT is not None:
+        print("NOTE: Serving S3 requests from local directory '%s'" % LOCAL_S3_ROOT)
+
+    # One client is shared by the listing and download threads, so its connection pool must hold a
+    # connection for each of them; botocore opens and discards extra connections rather than waiting
+    s3_client = open_s3_client(max(S3_DOWNLOAD_CONCURRENCY, LISTING_CONCURRENCY))
+    metadataQueries = MetadataQueries()
+    if event and event.get('mode') == 'worker':
+        return run_worker(s3_client, metadataQueries, event)
 
     # Create a list of analyzable S3 files
-    s3_client = boto3.client('s3')
-    s3_file_list = []
+    prefixes = []
     for prefix in PREFIX_STRINGS:
-        matched_file_list = list_s3_files_matching_prefix(s3_client, prefix)
-        print("Queried for S3 files matching prefix string '%s'. Found %d matching files." % (prefix, len(matched_file_list)))
-        print("Matching files: [%s]" % ", ".join(matched_file_list))
-        s3_file_list.extend(matched_file_list)
-
-    metadataQueries = MetadataQueries()
+        if PARTITION_PRUNING and not zonemap.prefix_may_match(prefix, [metadataQueries.queries[query_name] for query_name in METADATA_QUERIES], PARTITION_PRUNING_SLACK):
+            print("Skipping prefix string '%s': its dates lie outside every query's time window." % prefix)
+            continue
+        prefixes.append(prefix)
+    listings = list_s3_objects_for_prefixes(s3_client, prefixes)
+    s3_object_list = []
+    for prefix in prefixes:
+        matched_object_list = listings[prefix]
+        print("Queried for S3 files matching prefix string '%s'. Found %d matching files." % (prefix, len(matched_object_list)))
+        print("Matching files: [%s]" % ", ".join(s3_object.key for s3_object in matched_object_list))
+        s3_object_list.extend(matched_object_list)
+    s3_file_list = [s3_object.key for s3_object in s3_object_list]
+    versions = dict((s3_object.key, s3_object.version) for s3_object in s3_object_list)
+    sizes = dict((s3_object.key, s3_object.size) for s3_object in s3_object_list)
 
-    perform_query(s3_client, s3_file_list, metadataQueries, METADATA_QUERY)
-    return
+    if FAN_OUT_EXECUTOR is not None:
+        with metrics.profiled(PROFILE_OUTPUT_PATH):
+            perform_fanned_out_query(s3_object_list, metadataQueries, METADATA_QUERIES, create_fan_out_executor(context))
+        return
 
-def perform_query(s3_client, s3_file_list, query_object, query_function):
-    total_records = 0
-    total_records_in_timeframe = 0
-    total_records_not_in_timeframe = 0
-    file_num = 1
-    query_start_time = time.time()
+    # Leave time to write a checkpoint before Lambda stops the invocation
+    deadline = None
+    if context is not None and CHECKPOINT_LOCATION is not None:
+        deadline = time.time() + context.get_remaining_time_in_millis()/1000 - CHECKPOINT_TIME_RESERVE_SECONDS
 
-    invalid_s3_files = []
+    with metrics.profiled(PROFILE_OUTPUT_PATH):
+        perform_query(s3_client, s3_file_list, metadataQueries, METADATA_QUERIES, deadline=deadline, versions=versions, sizes=sizes)
+    return
 
-    for filename in s3_file_list:
-        file_process_start_time = time.time()
+### Runs every query in query_functions over s3_file_list in a single pass, returning a
+### {query_name: QueryResult} dict. With checkpointing enabled, files recorded in the checkpoint are
+### skipped and their results restored from it. If deadline (a time.time() value) passes first, the
+### run stops early and only its checkpoint is written. versions ({filename: version}) and sizes
+### ({filename: size}), e.g. from the listing, save looking versions up when caching, zone maps or
+### checkpointing need them and sizes up when prefetching.
+def perform_query(s3_client, s3_file_list, query_object, query_functions, workers=None, deadline=None, versions=None, sizes=None):
+    engine = QueryEngine(query_object, query_functions, VECTORIZED_BATCH_SIZE, STAGE_TIMING)
+    if workers is None:
+        workers = PARALLEL_WORKERS or os.cpu_count() or 1
+    checkpoint = open_checkpoint(s3_client)
+    cache = open_metadata_cache()
+    if checkpoint is None:
+        run_queries(s3_client, s3_file_list, engine, workers, versions, sizes, cache)
+    elif not process_files_with_checkpoints(s3_client, s3_file_list, engine, workers, checkpoint, deadline, versions, sizes, cache):
         print("============================================================================")
-        print("Analyzing file (%d/%d) '%s'" % (file_num, len(s3_file_list), filename))
-        print("Query being performed: %s" % str(METADATA_QUERY))
-        file_num += 1
-        record_list = extract_records_from_file(s3_client, filename)
-        records_in_timeframe = 0
-        records_not_in_timeframe = 0
-        for record in record_list:
-            total_records += 1
-            if getattr(query_object, query_function)(record):
-                records_in_timeframe += 1
-                if METADATA_QUERY == 'query11_invalidS3FileCount' and filename not in invalid_s3_files:
-                    invalid_s3_files.append(filename)
-            else:
-                records_not_in_timeframe += 1
-        print("Records satisfying query constraints found in this file: \t%d" % records_in_timeframe)
-        print("Total records found satisfying query constraints so far: \t\t%d" % total_records_in_timeframe)
-        print("Records NOT found satisfying query constraints: \t\t\t\t%d" % records_not_in_timeframe)
-        print("Total records NOT found satisfying query constraints so far: \t\t\t%d" % total_records_not_in_timeframe)
-        time_now = time.time()
-        print("Time taken to process this file: \t\t\t%.3f" % (time_now - file_process_start_time))
-        time_elapsed = (time_now - query_start_time)
-        avg_time_per_file = time_elapsed/file_num
-        avg_time_per_record = time_elapsed/total_records
-        est_time_remaining = avg_time_per_file * (len(s3_file_list) - file_num)
-        print("Time elapsed so far: \t\t\t\t\t%.3f" % time_elapsed)
-        print("Average time per file: \t\t\t\t\t%.3f" % avg_time_per_file)
-        print("Average time per record: \t\t\t\t%.6f" % avg_time_per_record)
-        print("Estimated time remaining: \t\t\t\t%.3f" % est_time_remaining)
-        total_records_in_timeframe += records_in_timeframe
-        total_records_not_in_timeframe += records_not_in_timeframe
+        print("Querying stopped before the time limit. Progress was saved to checkpoint '%s'; run again to resume." % CHECKPOINT_LOCATION)
+        report_metrics(engine)
+        return engine.results
     print("============================================================================")
     print("Querying complete.")
+    report_results(engine)
+    return engine.results
+
+### Splits s3_object_list into shards, runs a worker over each shard with executor and merges the
+### workers' partial results (in shard order, so results match a single-invocation run). Returns a
+### {query_name: QueryResult} dict.
+def perform_fanned_out_query(s3_object_list, query_object, query_functions, executor):
+    shards = fanout.make_shards(s3_object_list, FAN_OUT_SHARD_BYTES)
+    print("Splitting %d files into %d shards of up to %d bytes." % (len(s3_object_list), len(shards), FAN_OUT_SHARD_BYTES))
+    events = []
+    for shard_number, shard in enumerate(shards):
+        events.append({
+            'mode': 'worker',
+            'shard': shard_number,
+            'queries': list(query_functions),
+            'files': [[s3_object.key, s3_object.version, s3_object.size] for s3_object in shard],
+        })
+    engine = QueryEngine(query_object, query_functions, VECTORIZED_BATCH_SIZE, STAGE_TIMING)
+    responses = executor.map(events)
+
+    # Fan-in
+    for event, response in zip(events, responses):
+        if response.get('shard') != event['shard']:
+            raise RuntimeError("Worker response for shard %s does not match the shard requested (%d)" % (response.get('shard'), event['shard']))
+        partial_engine = engine.partial()
+        partial_engine.load_state(response['results'])
+        partial_engine.metrics.load(response['metrics'])
+        engine.merge(partial_engine)
+    print("============================================================================")
+    print("Querying complete. Merged results of %d shards." % len(shards))
+    report_results(engine)
+    return engine.results
 
-    ### Query-specific output
-    if hasattr(query_object, 'earliest_generated_at'):
-        print("Earliest record_generated_at: %s" % query_object.earliest_generated_at)
-    if hasattr(query_object, 'latest_generated_at'):
-        print("Latest record_generated_at: %s" % query_object.latest_generated_at)
-    if METADATA_QUERY == 'query11_invalidS3FileCount':
+### Handles a {'mode': 'worker'} event: runs the event's queries over its shard of files (given as
+### [key, version, size] lists) and returns the shard's partial results for the coordinator to merge
+def run_worker(s3_client, query_object, event):
+    engine = QueryEngine(query_object, event['queries'], VECTORIZED_BATCH_SIZE, STAGE_TIMING)
+    s3_file_list = [key for key, _, _ in event['files']]
+    versions = dict((key, version) for key, version, _ in event['files'])
+    sizes = dict((key, size) for key, _, size in event['files'])
+    print("Worker processing shard %d (%d files)" % (event['shard'], len(s3_file_list)))
+    run_queries(s3_client, s3_file_list, engine, PARALLEL_WORKERS or os.cpu_count() or 1, versions, sizes, open_metadata_cache())
+    return {'shard': event['shard'], 'results': engine.state_dict(), 'metrics': engine.metrics.to_dict()}
+
+def create_fan_out_executor(context):
+    if FAN_OUT_EXECUTOR == 'lambda':
+        function_name = FAN_OUT_LAMBDA_FUNCTION or (context.function_name if context is not None else None)
+        if function_name is None:
+            raise ValueError("FAN_OUT_LAMBDA_FUNCTION must be set when not running on Lambda")
+        return fanout.LambdaExecutor(function_name, FAN_OUT_CONCURRENCY)
+    if FAN_OUT_EXECUTOR == 'multiprocessing':
+        return fanout.MultiprocessingExecutor(lambda_handler, FAN_OUT_CONCURRENCY)
+    if FAN_OUT_EXECUTOR == 'in_process':
+        return fanout.InProcessExecutor(lambda_handler)
+    raise ValueError("Unknown fan-out executor '%s'" % FAN_OUT_EXECUTOR)
+
+### Runs the engine over s3_file_list with the given number of worker processes, reading and filling
+### the metadata cache if one is given
+def run_queries(s3_client, s3_file_list, engine, workers, versions=None, sizes=None, cache=None):
+    workers = min(workers, len(s3_file_list))
+    if workers > 1:
+        process_files_in_parallel(s3_client, s3_file_list, engine, workers, versions, sizes, cache)
+    else:
+        process_files(s3_client, s3_file_list, engine, versions, sizes=sizes, cache=cache)
+
+### Prints the results of every query, writing file lists to disk for the queries that produce them
+def report_results(engine):
+    if 'query8_earliestGeneratedAt' in engine.results:
+        print("Earliest record_generated_at: %s" % engine.results['query8_earliestGeneratedAt'].aggregate.value)
+    if 'query9_latestGeneratedAt' in engine.results:
+        print("Latest record_generated_at: %s" % engine.results['query9_latestGeneratedAt'].aggregate.value)
+    if 'query11_invalidS3FileCount' in engine.results:
+        invalid_s3_files = engine.results['query11_invalidS3FileCount'].satisfying_files
         print("Invalid s3 file count: %d" % len(invalid_s3_files))
-        invalid_s3_file_out = open('invalid_s3_file_list.txt', 'w')
-        invalid_s3_file_out.write("%s" % "\n".join(invalid_s3_files))
-        print("Invalid S3 files written to 'invalid_s3_file_list.txt'")
-    if METADATA_QUERY == 'query13_listOfLogFilesBefore':
-        print("Invalid log file count: %d" % len(query_object.log_file_list))
-        invalid_log_file_list_out = open('invalid_log_file_list.txt', 'w')
-        invalid_log_file_list_out.write("%s" % "\n".join(query_object.log_file_list.keys()))
-        print("Invalid S3 files written to 'invalid_log_file_list.txt'")
-
-    print("Total number of records found satisfying query constraints: %d (Total number of records not found satisfying query constraints: %d" % (total_records_in_timeframe, total_records_not_in_timeframe))
-
-### Returns a list of records from a given file
-def extract_records_from_file(s3_client, filename):
+        path = write_lines('invalid_s3_file_list.txt', invalid_s3_files)
+        print("Invalid S3 files written to '%s'" % path)
+    if 'query13_listOfLogFilesBefore' in engine.results:
+        log_file_list = engine.results['query13_listOfLogFilesBefore'].aggregate
+        print("Invalid log file count: %d" % len(log_file_list))
+        path = write_lines('invalid_log_file_list.txt', log_file_list.keys())
+        print("Invalid S3 files written to '%s'" % path)
+
+    for query_name in engine.query_names:
+        result = engine.results[query_name]
+        print("[%s] Total number of records found satisfying query constraints: %d (Total number of records not found satisfying query constraints: %d)" % (query_name, result.records_satisfying, result.records_not_satisfying))
+    report_metrics(engine)
+
+### Writes lines (separated, not terminated, by newlines) to path one at a time, compressed with
+### OUTPUT_COMPRESSION. Returns the path written, which has the compression's extension appended.
+def write_lines(path, lines):
+    output, path = open_text_output(path, OUTPUT_COMPRESSION)
+    with output:
+        separator = ""
+        for line in lines:
+            output.write(separator)
+            output.write(line)
+            separator = "\n"
+    return path
+
+### Prints the run's metrics as JSON, also writing them to METRICS_PATH if set
+def report_metrics(engine):
+    summary = engine.metrics.summary()
+    print("Run metrics: %s" % json.dumps(summary))
+    if METRICS_PATH is not None:
+        with open(METRICS_PATH, 'w') as metrics_out:
+            json.dump(summary, metrics_out, indent=2)
+
+### Runs the engine over s3_file_list in order, restoring earlier results from checkpoint and saving
+### progress to it every CHECKPOINT_INTERVAL_SECONDS and at the end. Returns False if deadline passed
+### before every file was processed.
+def process_files_with_checkpoints(s3_client, s3_file_list, engine, workers, checkpoint, deadline=None, versions=None, sizes=None, cache=None):
+    processed = restore_checkpoint(checkpoint, engine)
+    if versions is None:
+        versions = get_object_versions(s3_client, s3_file_list)
+    changed_files = [filename for filename in s3_file_list if filename in processed and processed[filename] != versions[filename]]
+    if changed_files:
+        print("WARNING: %d files changed since they were processed and will not be reprocessed: [%s]" % (len(changed_files), ", ".join(changed_files)))
+    pending_files = [filename for filename in s3_file_list if filename not in processed]
+    print("NOTE: %d of %d files already processed according to checkpoint '%s'" % (len(s3_file_list) - len(pending_files), len(s3_file_list), CHECKPOINT_LOCATION))
+
+    last_save_time = time.time()
+    def save_progress(filenames):
+        nonlocal last_save_time
+        for filename in filenames:
+            processed[filename] = versions[filename]
+        if time.time() - last_save_time >= CHECKPOINT_INTERVAL_SECONDS:
+            checkpoint.save(engine.query_names, processed, engine.state_dict(), False)
+            last_save_time = time.time()
+
+    workers = min(workers, len(pending_files))
+    if workers > 1:
+        # Workers cannot report back until they finish, so files are handed out in rounds
+        round_size = workers * CHECKPOINT_FILES_PER_ROUND
+        complete = True
+        for round_start in range(0, len(pending_files), round_size):
+            if deadline is not None and time.time() >= deadline:
+                complete = False
+                break
+            round_files = pending_files[round_start:round_start+round_size]
+            process_files_in_parallel(s3_client, round_files, engine, min(workers, len(round_files)), versions, sizes, cache)
+            save_progress(round_files)
+    else:
+        complete = process_files(s3_client, pending_files, engine, versions, lambda filename: save_progress([filename]), deadline, sizes, cache)
+    checkpoint.save(engine.query_names, processed, engine.state_dict(), complete)
+    return complete
+
+### Restores engine results from checkpoint and returns the {filename: version} dict of files they
+### cover, or an empty dict if the checkpoint is missing, unusable or (in resume mode) already complete
+def restore_checkpoint(checkpoint, engine):
+    state = checkpoint.load()
+    if state is None:
+        return {}
+    if sorted(state['queries']) != sorted(engine.query_names):
+        print("WARNING: Checkpoint '%s' was written for different queries (%s), starting over" % (CHECKPOINT_LOCATION, ", ".join(state['queries'])))
+        return {}
+    if CHECKPOINT_MODE == 'resume' and state['complete']:
+        print("NOTE: Checkpoint '%s' is of a finished run, starting over" % CHECKPOINT_LOCATION)
+        return {}
+    engine.load_state(state['results'])
+    return state['processed']
+
+def open_checkpoint(s3_client):
+    if CHECKPOINT_LOCATION is None:
+        return None
+    if CHECKPOINT_MODE not in ('resume', 'incremental'):
+        raise ValueError("Unknown checkpoint mode '%s'" % CHECKPOINT_MODE)
+    return Checkpoint(CHECKPOINT_LOCATION, s3_client)
+
+### Sequentially runs the engine over every file in s3_file_list, calling on_file_processed(filename)
+### after each one. versions ({filename: version}) is looked up if needed and not given, as are the
+### sizes ({filename: size}) of prefetched objects. Files are read from and added to cache (a
+### MetadataCache) if given. Returns False if deadline (a time.time() value) passed before every file
+### was processed.
+def process_files(s3_client, s3_file_list, engine, versions=None, on_file_processed=None, deadline=None, sizes=None, cache=None):
+    zone_maps = open_zone_maps()
+    if versions is None:
+        versions = get_object_versions(s3_client, s3_file_list) if cache is not None or zone_maps is not None else {}
+    run_metrics = engine.metrics
+    progress = metrics.ProgressReporter(len(s3_file_list), PROGRESS_INTERVAL_SECONDS, run_metrics)
+
+    # Files answered from their zone maps are never read
+    stats_answers = {}
+    if zone_maps is not None:
+        for filename in s3_file_list:
+            stats = zone_maps.get(filename, versions[filename])
+            if stats is not None:
+                satisfying = engine.satisfying_from_stats(stats)
+                if satisfying is not None:
+                    stats_answers[filename] = (satisfying, stats['records'])
+    file_records = iterate_file_records(s3_client, [filename for filename in s3_file_list if filename not in stats_answers], versions, cache, engine, sizes)
+
+    complete = True
+    for file_num, filename in enumerate(s3_file_list):
+        if deadline is not None and time.time() >= deadline:
+            print("Stopping before the time limit with %d files left to process." % (len(s3_file_list) - file_num))
+            file_records.close()
+            complete = False
+            break
+        if filename in stats_answers:
+            satisfying, record_count = stats_answers[filename]
+            engine.process_stats_answer(satisfying, record_count, filename)
+        else:
+            fetch_start = time.perf_counter()
+            _, version, record_list, cached_columns = next(file_records)
+            run_metrics.seconds['fetch'] += time.perf_counter() - fetch_start
+            if cached_columns is not None:
+                engine.process_columns(cached_columns[0], cached_columns[1], filename)
+                if zone_maps is not None and zone_maps.get(filename, version) is None:
+                    stats_collector = zonemap.FileStatsCollector()
+                    stats_collector.add_columns(cached_columns[0], cached_columns[1])
+                    zone_maps.put(filename, version, stats_collector.stats())
+            else:
+                if run_metrics.stage_timing:
+                    metadata_iterable = run_metrics.timed_map('decode', extract_metadata, record_list)
+                else:
+                    metadata_iterable = map(extract_metadata, record_list)
+                # Entries already cached (but unusable for these queries) are not written again
+                caching = cache is not None and not cache.contains(filename, version)
+                if caching:
+                    collector = ColumnCollector(cache.fields)
+                    metadata_iterable = collector.collect(metadata_iterable)
+                if zone_maps is not None:
+                    stats_collector = zonemap.FileStatsCollector()
+                    metadata_iterable = stats_collector.collect(metadata_iterable)
+                engine.process_metadata(metadata_iterable, filename)
+                if caching:
+                    cache.put(filename, version, collector.columns, collector.record_count)
+                if zone_maps is not None:
+                    zone_maps.put(filename, version, stats_collector.stats())
+        if on_file_processed is not None:
+            on_file_processed(filename)
+        progress.update(file_num + 1)
+    else:
+        progress.update(len(s3_file_list), force=True)
+    if zone_maps is not None:
+        zone_maps.save()
+    return complete
+
+### Splits s3_file_list into one contiguous chunk per worker process and merges each worker's partial
+### engine state back into engine. Chunks are merged in file order, so results (including the order of
+### matching files) are identical to a sequential run.
+def process_files_in_parallel(s3_client, s3_file_list, engine, workers, versions=None, sizes=None, cache=None):
+    # boto3 clients and their connection pools must not be shared across processes, so each worker
+    # creates its own; the filesystem-backed stand-in holds no connections and is passed through
+    worker_s3_client = s3_client if isinstance(s3_client, LocalS3Client) else None
+    chunk_size = -(-len(s3_file_list) // workers)
+    chunks = [s3_file_list[chunk_start:chunk_start+chunk_size] for chunk_start in range(0, len(s3_file_list), chunk_size)]
+    partial_engines = fanout.run_in_processes(_process_files_worker, [(worker_s3_client, chunk, engine.partial(), versions, sizes, cache) for chunk in chunks], workers)
+    for partial_engine in partial_engines:
+        engine.merge(partial_engine)
+
+def _process_files_worker(s3_client, s3_file_list, engine, versions=None, sizes=None, cache=None):
+    process_files(s3_client or open_s3_client(S3_DOWNLOAD_CONCURRENCY), s3_file_list, engine, versions, sizes=sizes, cache=cache)
+    return engine
+
+### Returns an S3 client whose connection pool holds max_pool_connections, or the filesystem-backed
+### stand-in serving LOCAL_S3_ROOT if it is set
+def open_s3_client(max_pool_connections):
+    if LOCAL_S3_ROOT is not None:
+        return LocalS3Client(LOCAL_S3_ROOT)
+    return create_s3_client(max_pool_connections)
+
+def open_metadata_cache():
+    if METADATA_CACHE_DIRECTORY is None:
+        return None
+    return MetadataCache(METADATA_CACHE_DIRECTORY, METADATA_CACHE_MAX_BYTES)
+
+### Returns an identifier that changes whenever the given file changes: the ETag of an S3 object, or
+### the size and modification time of a local file
+def get_object_version(s3_client, filename):
+    if USE_LOCAL_DATA:
+        return listing.local_file_version(os.stat(filename))
+    else:
+        return s3_client.head_object(Bucket=S3_BUCKET, Key=filename)['ETag']
+
+def open_zone_maps():
+    if ZONE_MAP_PATH is None:
+        return None
+    return zonemap.ZoneMapIndex(ZONE_MAP_PATH)
+
+### Returns {filename: version} for every file, looking versions up concurrently
+def get_object_versions(s3_client, s3_file_list):
+    with ThreadPoolExecutor(max_workers=S3_DOWNLOAD_CONCURRENCY) as executor:
+        return dict(zip(s3_file_list, executor.map(lambda filename: get_object_version(s3_client, filename), s3_file_list)))
+
+### Yields (filename, version, records, cached_columns) for every file in s3_file_list, in order.
+### Files whose current version is in the metadata cache (and whose cached fields cover everything the
+### engine's queries need) come with cached_columns = (columns, record_count) and no records; all
+### other files come with a record iterator. When reading from S3 the uncached objects are prefetched
+### concurrently while earlier ones are being queried, using sizes ({filename: size}) where given.
+### version is None if versions has no entry.
+def iterate_file_records(s3_client, s3_file_list, versions=None, cache=None, engine=None, sizes=None):
+    versions = versions or {}
+    cached_files = set()
+    if cache is not None and (engine is None or cache.covers(engine.fields + engine.timestamp_fields)):
+        cached_files = set(filename for filename in s3_file_list if cache.contains(filename, versions[filename]))
+    uncached_records = _iterate_uncached_records(s3_client, [filename for filename in s3_file_list if filename not in cached_files], engine.metrics if engine is not None else None, sizes)
+    for filename in s3_file_list:
+        if filename in cached_files:
+            cached_columns = cache.get(filename, versions[filename])
+            if cached_columns is not None:
+                yield filename, versions[filename], None, cached_columns
+            else: # evicted since it was looked up
+                yield filename, versions[filename], extract_records_from_file(s3_client, filename, engine.metrics if engine is not None else None), None
+        else:
+            _, records = next(uncached_records)
+            yield filename, versions.get(filename), records, None
+
+def _iterate_uncached_records(s3_client, s3_file_list, run_metrics=None, sizes=None):
+    if not USE_LOCAL_DATA and S3_PREFETCH_COUNT > 0:
+        prefetcher = S3Prefetcher(s3_client, S3_BUCKET, s3_file_list, S3_PREFETCH_COUNT, S3_DOWNLOAD_CONCURRENCY, S3_MAX_IN_FLIGHT_BYTES, sizes)
+        for filename, stream in prefetcher:
+            yield filename, iter_stream_records(stream, filename, READ_BUFFER_SIZE, run_metrics)
+    else:
+        for filename in s3_file_list:
+            yield filename, extract_records_from_file(s3_client, filename, run_metrics)
+
+### Yields the records of a given file one at a time, counting reads in run_metrics if given
+def extract_records_from_file(s3_client, filename, run_metrics=None):
     if USE_LOCAL_DATA:
-        with open(filename, 'r') as f:
-            return f.readlines()
+        return iter_local_file_records(filename, READ_BUFFER_SIZE, run_metrics)
     else:
-        s3_file = s3_client.get_object(
-            Bucket=S3_BUCKET,
-            Key=filename,
-        )
-        return list(s3_file['Body'].iter_lines()) ### iter_lines() is significantly faster than read().splitlines()
+        return iter_s3_object_records(s3_client, S3_BUCKET, filename, READ_BUFFER_SIZE, run_metrics)
 
 ### Returns filenames from an S3 list files (list_objects) query
 def list_s3_files_matching_prefix(s3_client, prefix_string):
+    return [s3_object.key for s3_object in list_s3_objects_matching_prefix(s3_client, prefix_string)]
+
+### Returns an ObjectInfo (key, size and version) for every object matching the prefix
+def list_s3_objects_matching_prefix(s3_client, prefix_string):
     if USE_LOCAL_DATA:
-        try:
-            files_and_directories = glob.glob(LOCAL_DATA_REPOSITORY+"/"+prefix_string+"/**/*", recursive=True)
-            files_only = []
-            for filepath in files_and_directories:
-                if os.path.isfile(filepath):
-                    files_only.append(filepath)
-            return files_only
-        except FileNotFoundError as e:
-            return []
+        return listing.walk_local_prefix(LOCAL_DATA_REPOSITORY, prefix_string)
     else:
-        response = list_s3_objects(s3_client, prefix_string)
-        filenames = []
-        if response.get('Contents'):
-            [filenames.append(item['Key']) for item in response.get('Contents')]
-        while response.get('NextContinuationToken'):
-            response = list_s3_objects(s3_client, prefix_string, response.get('NextContinuationToken'))
-            if response.get('Contents'):
-                [filenames.append(item['Key']) for item in response.get('Contents')]
-        return filenames
-
-def list_s3_objects(s3_client, prefix_string, continuation_token=None):
-    if continuation_token:
-        return s3_client.list_objects_v2(
-            Bucket=S3_BUCKET,
-            Prefix=prefix_string,
-            ContinuationToken=continuation_token,
-        )
+        return listing.list_s3_prefixes(s3_client, S3_BUCKET, [prefix_string], LISTING_CONCURRENCY)[prefix_string]
+
+### Returns {prefix: [ObjectInfo]} for every prefix. Prefixes listed recently enough are taken from the
+### listing manifest (if enabled); the rest are listed concurrently, diffed against their previous
+### listing and saved to the manifest.
+def list_s3_objects_for_prefixes(s3_client, prefixes):
+    manifest = listing.ListingManifest(LISTING_MANIFEST_PATH) if LISTING_MANIFEST_PATH is not None else None
+    source = "local:%s" % LOCAL_DATA_REPOSITORY if USE_LOCAL_DATA else "s3:%s" % S3_BUCKET
+    listings = {}
+    previous_listings = {}
+    now = datetime.datetime.now(datetime.timezone.utc)
+    for prefix in prefixes:
+        saved = manifest.get(prefix, source) if manifest is not None else None
+        if saved is not None and now - saved[0] <= LISTING_MANIFEST_MAX_AGE:
+            print("Reusing listing of prefix string '%s' from manifest '%s' (listed at %s)." % (prefix, LISTING_MANIFEST_PATH, saved[0].isoformat()))
+            listings[prefix] = saved[1]
+        elif saved is not None:
+            previous_listings[prefix] = saved[1]
+
+    prefixes_to_list = [prefix for prefix in prefixes if prefix not in listings]
+    if USE_LOCAL_DATA:
+        new_listings = dict((prefix, listing.walk_local_prefix(LOCAL_DATA_REPOSITORY, prefix)) for prefix in prefixes_to_list)
     else:
-        return s3_client.list_objects_v2(
-            Bucket=S3_BUCKET,
-            Prefix=prefix_string,
-        )
+        new_listings = listing.list_s3_prefixes(s3_client, S3_BUCKET, prefixes_to_list, LISTING_CONCURRENCY)
+    for prefix, objects in new_listings.items():
+        if prefix in previous_listings:
+            added, changed, removed = listing.diff_listings(previous_listings[prefix], objects)
+            if added or changed or removed:
+                print("Listing of prefix string '%s' differs from manifest by %d new, %d changed and %d removed files." % (prefix, len(added), len(changed), len(removed)))
+        if manifest is not None:
+            manifest.put(prefix, source, objects, now)
+        listings[prefix] = objects
+    if manifest is not None and new_listings:
+        manifest.save()
+    return listings
 
 if __name__ == "__main__":
     lambda_handler(None, None)
@@ -0,0 +1,119 @@
+import contextlib
+import cProfile
+import pstats
+import time
+
+### Run metrics and progress reporting. Counters and per-stage timings are mergeable like query results,
+### so the metrics of worker processes and fan-out workers fold into those of the whole run.
+###
+### Stages: fetch (waiting for objects and reading and decompressing their bytes, or reading cache entries), decode
+### (decoding metadata blocks), timestamp_parse (extracting queried fields and parsing timestamps),
+### predicate (evaluating where clauses) and aggregate (updating aggregates). Fetch is timed per read
+### and always measured; the other stages are timed per record, which adds some overhead, so they are
+### only measured with stage_timing enabled.
+
+STAGES = ('fetch', 'decode', 'timestamp_parse', 'predicate', 'aggregate')
+
+COUNTERS = ('files', 'files_from_cache', 'files_from_zone_maps', 'records', 'bytes_read')
+
+class RunMetrics:
+    def __init__(self, stage_timing=False):
+        self.stage_timing = stage_timing
+        self.started_at = time.time()
+        self.counters = dict.fromkeys(COUNTERS, 0)
+        self.seconds = dict.fromkeys(STAGES, 0.0)
+
+    ### Returns a replacement for stream.read that counts the bytes read and the time spent reading
+    def metered_read(self, stream):
+        read = stream.read
+        counters = self.counters
+        seconds = self.seconds
+        def metered(size):
+            start = time.perf_counter()
+            chunk = read(size)
+            seconds['fetch'] += time.perf_counter() - start
+            counters['bytes_read'] += len(chunk)
+            return chunk
+        return metered
+
+    ### Like map(function, iterable), adding the time spent in function to the given stage
+    def timed_map(self, stage, function, iterable):
+        seconds = self.seconds
+        clock = time.perf_counter
+        for item in iterable:
+            start = clock()
+            result = function(item)
+            seconds[stage] += clock() - start
+            yield result
+
+    def merge(self, other):
+        for counter in COUNTERS:
+            self.counters[counter] += other.counters[counter]
+        for stage in STAGES:
+            self.seconds[stage] += other.seconds[stage]
+
+    def to_dict(self):
+        return {'counters': dict(self.counters), 'seconds': dict(self.seconds)}
+
+    def load(self, state):
+        self.counters.update(state['counters'])
+        self.seconds.update(state['seconds'])
+
+    ### JSON-serializable summary of the run so far, including throughput over the wall-clock time
+    ### since these metrics were created
+    def summary(self):
+        elapsed = time.time() - self.started_at
+        summary = dict(self.counters)
+        summary['elapsed_seconds'] = round(elapsed, 3)
+        summary['records_per_second'] = round(self.counters['records'] / elapsed, 1) if elapsed > 0 else None
+        summary['megabytes_per_second'] = round(self.counters['bytes_read'] / 1e6 / elapsed, 3) if elapsed > 0 else None
+        measured_stages = STAGES if self.stage_timing else ('fetch',)
+        summary['stage_seconds'] = dict((stage, round(self.seconds[stage], 3)) for stage in measured_stages)
+        return summary
+
+### Prints one progress line at most every interval_seconds, covering the files, records and bytes
+### processed since the reporter was created
+class ProgressReporter:
+    def __init__(self, total_files, interval_seconds, metrics):
+        self.total_files = total_files
+        self.interval_seconds = interval_seconds
+        self.metrics = metrics
+        self.start_time = time.time()
+        self.last_report_time = self.start_time
+        self.last_reported_files = None
+        self.start_records = metrics.counters['records']
+        self.start_bytes = metrics.counters['bytes_read']
+
+    ### Reports progress if interval_seconds have passed since the last report, or always with force
+    ### unless the same progress was just reported
+    def update(self, files_done, force=False):
+        now = time.time()
+        if force and files_done == self.last_reported_files:
+            return
+        if not force and now - self.last_report_time < self.interval_seconds:
+            return
+        self.last_report_time = now
+        self.last_reported_files = files_done
+        elapsed = max(now - self.start_time, 1e-9)
+        records = self.metrics.counters['records'] - self.start_records
+        megabytes = (self.metrics.counters['bytes_read'] - self.start_bytes) / 1e6
+        remaining = elapsed / files_done * (self.total_files - files_done) if files_done else 0.0
+        print("Progress: %d/%d files, %d records (%.0f records/s), %.1f MB read (%.1f MB/s), %.1fs elapsed, %.1fs estimated remaining" % (
+            files_done, self.total_files, records, records / elapsed, megabytes, megabytes / elapsed, elapsed, remaining))
+
+### Runs the enclosed code under cProfile if path is set, saving the stats to path and printing the
+### functions with the highest cumulative time
+@contextlib.contextmanager
+def profiled(path, top=20):
+    if path is None:
+        yield
+        return
+    profiler = cProfile.Profile()
+    profiler.enable()
+    try:
+        yield
+    finally:
+        profiler.disable()
+        profiler.dump_stats(path)
+        print("Profile written to '%s'. Top %d functions by cumulative time:" % (path, top))
+        pstats.Stats(profiler).sort_stats('cumulative').print_stats(top)
@@ -1,101 +1,83 @@
 import ciso8601
-import json
+from aggregates import Count, DistinctSet, GroupCount, Max, Min
 
-class MetadataQueries:
-    def __init__(self):
-        pass
+BSM_PAYLOAD_TYPE = 'us.dot.its.jpo.ode.model.OdeBsmPayload'
+
+### Metadata fields holding timestamps. These are parsed into naive datetimes (once per record) before
+### any query sees them, and constants compared against them are parsed once when a query is compiled.
+TIMESTAMP_FIELDS = ('odeReceivedAt', 'recordGeneratedAt')
+
+### Key used to count records that have no value for a group_count field
+MISSING_GROUP_KEY = '_missing'
+
+### Boundary dates used by the bug queries
+MONITORING_START = '2018-12-03T00:00:00.000Z'
+NON_TMC_BUG_FIX = '2019-02-13T00:00:00.000Z'
+BUG_FIX = '2019-04-12T00:00:00.000Z' # dateOfBugFix
+
+### Records affected by the metadata bug: non-TMC, non-BSM records received before the non-TMC fix,
+### and BSM records received before the full fix
+BUG_WINDOW = [
+    [('odeReceivedAt', '>', MONITORING_START), ('odeReceivedAt', '<', NON_TMC_BUG_FIX), ('recordGeneratedBy', '!=', 'TMC'), ('payloadType', '!=', BSM_PAYLOAD_TYPE)],
+    [('odeReceivedAt', '>', MONITORING_START), ('odeReceivedAt', '<', BUG_FIX), ('payloadType', '==', BSM_PAYLOAD_TYPE)],
+]
 
+### Query definitions. Each query is declared as data:
+###   'where':     OR of AND clauses, each condition a (metadata field, operator, value) tuple. Omit to
+###                select every record.
+###   'aggregate': ('count',), ('min', field), ('max', field), ('distinct', field) or ('group_count', field)
+### Every query also reports how many records did and did not satisfy it and which files contained
+### satisfying records. Adding a query only requires adding an entry here.
+QUERY_DEFINITIONS = {
     #############
     # Query Name:
     #   query1_totalRecordCount
     # Pseudoquery:
     #   totalRecordCount = SELECT COUNT(*) WHERE metadata.odeReceivedAt >= 12/3/2018 AND metadata.odeReceivedAt < 4/12/2019
-    def query1_totalRecordCount(self, record):
-        start_time = ciso8601.parse_datetime_as_naive('2018-12-03T00:00:00.000Z')
-        end_time = ciso8601.parse_datetime_as_naive('2019-04-12T00:00:00.000Z')
-        received_at_string = json.loads(record)['metadata']['odeReceivedAt']
-        try:
-            received_at = ciso8601.parse_datetime_as_naive(received_at_string)
-        except Exception as e:
-            print("[ERROR] Was unable to parse timestamp. Timestamp: %s. Error: %s" % (received_at_string, str(e)))
-            raise SystemExit
-        return received_at > start_time and received_at < end_time
+    'query1_totalRecordCount': {
+        'where': [[('odeReceivedAt', '>', MONITORING_START), ('odeReceivedAt', '<', BUG_FIX)]],
+        'aggregate': ('count',),
+    },
 
     #############
     # Query Name:
     #   query2_timBroadcastRecordCount
     # Pseudoquery:
     #   timBroadcastRecordCount = SELECT COUNT(*) WHERE metadata.odeReceivedAt >= 12/3/2018 AND metadata.odeReceivedAt < 4/12/2019 AND metadata.recordGeneratedBy == TMC
-    def query2_timBroadcastRecordCount(self, record):
-        start_time = ciso8601.parse_datetime_as_naive('2018-12-03T00:00:00.000Z')
-        end_time = ciso8601.parse_datetime_as_naive('2019-04-12T00:00:00.000Z')
-        record_object = json.loads(record)
-        received_at_string = record_object['metadata']['odeReceivedAt']
-        record_generated_by = record_object['metadata']['recordGeneratedBy']
-        try:
-            received_at = ciso8601.parse_datetime_as_naive(received_at_string)
-        except Exception as e:
-            print("[ERROR] Was unable to parse timestamp. Timestamp: %s. Error: %s" % (received_at_string, str(e)))
-            raise SystemExit
-        return received_at > start_time and received_at < end_time and record_generated_by == 'TMC'
+    'query2_timBroadcastRecordCount': {
+        'where': [[('odeReceivedAt', '>', MONITORING_START), ('odeReceivedAt', '<', BUG_FIX), ('recordGeneratedBy', '==', 'TMC')]],
+        'aggregate': ('count',),
+    },
 
     #############
     # Query Name:
     #   query3_goodOtherRecordCount
     # Pseudoquery:
-    #   goodOtherRecordCount = SELECT COUNT(*) WHERE metadata.odeReceivedAt >= 2/13/2019 AND metadata.odeReceivedAt < dateOfBugFix AND metadata.payloadType != us.dot.its.jpo.ode.model.OdeBsmPayload AND metadata.recordGeneratedBy != TMC
-    def query3_goodOtherRecordCount(self, record):
-        start_time = ciso8601.parse_datetime_as_naive('2019-02-13T00:00:00.000Z')
-        end_time = ciso8601.parse_datetime_as_naive('2019-04-12T00:00:00.000Z')
-        record_object = json.loads(record)
-        received_at_string = record_object['metadata']['odeReceivedAt']
-        payload_type = record_object['metadata']['payloadType']
-        record_generated_by = record_object['metadata']['recordGeneratedBy']
-        try:
-            received_at = ciso8601.parse_datetime_as_naive(received_at_string)
-        except Exception as e:
-            print("[ERROR] Was unable to parse timestamp. Timestamp: %s. Error: %s" % (received_at_string, str(e)))
-            raise SystemExit
-        return received_at > start_time and received_at < end_time and payload_type != 'us.dot.its.jpo.ode.model.OdeBsmPayload' and record_generated_by != 'TMC'
+    #   goodOtherRecordCount = SELECT COUNT(*) WHERE metadata.odeReceivedAt >= 2/13/2019 AND metadata.odeReceivedAt < dateOfBugFix AND metadata.payloadType != us.dot.its.jpo.ode.model.OdeBsmPayload AND metadata.recordGeneratedBy != TMC
+    'query3_goodOtherRecordCount': {
+        'where': [[('odeReceivedAt', '>', NON_TMC_BUG_FIX), ('odeReceivedAt', '<', BUG_FIX), ('payloadType', '!=', BSM_PAYLOAD_TYPE), ('recordGeneratedBy', '!=', 'TMC')]],
+        'aggregate': ('count',),
+    },
 
     #############
     # Query Name:
     #   query4_badBsmRecordCount
     # Pseudoquery:
     #   badBsmRecordCount = SELECT COUNT(*) WHERE metadata.odeReceivedAt >= 12/3/2018 AND metadata.odeReceivedAt < dateOfBugFix AND metadata.payloadType == us.dot.its.jpo.ode.model.OdeBsmPayload
-    def query4_badBsmRecordCount(self, record):
-        start_time = ciso8601.parse_datetime_as_naive('2018-12-03T00:00:00.000Z')
-        end_time = ciso8601.parse_datetime_as_naive('2019-04-12T00:00:00.000Z')
-        record_object = json.loads(record)
-        received_at_string = record_object['metadata']['odeReceivedAt']
-        payload_type = record_object['metadata']['payloadType']
-        try:
-            received_at = ciso8601.parse_datetime_as_naive(received_at_string)
-        except Exception as e:
-            print("[ERROR] Was unable to parse timestamp. Timestamp: %s. Error: %s" % (received_at_string, str(e)))
-            raise SystemExit
-        return received_at > start_time and received_at < end_time and payload_type == 'us.dot.its.jpo.ode.model.OdeBsmPayload'
+    'query4_badBsmRecordCount': {
+        'where': [[('odeReceivedAt', '>', MONITORING_START), ('odeReceivedAt', '<', BUG_FIX), ('payloadType', '==', BSM_PAYLOAD_TYPE)]],
+        'aggregate': ('count',),
+    },
 
     #############
     # Query Name:
     #   query5_badOtherRecordCount
     # Pseudoquery:
     #   badOtherRecordCount = SELECT COUNT(*) WHERE metadata.odeReceivedAt >= 12/3/2018 AND metadata.odeReceivedAt <= 2/12/2019 AND metadata.recordGeneratedBy != TMC AND metadata.payloadType != us.dot.its.jpo.ode.model.OdeBsmPayload
-    def query5_badOtherRecordCount(self, record):
-        start_time = ciso8601.parse_datetime_as_naive('2018-12-03T00:00:00.000Z')
-        end_time = ciso8601.parse_datetime_as_naive('2019-02-13T00:00:00.000Z')
-        record_object = json.loads(record)
-        received_at_string = record_object['metadata']['odeReceivedAt']
-        record_generated_by = record_object['metadata']['recordGeneratedBy']
-        payload_type = record_object['metadata']['payloadType']
-        try:
-            received_at = ciso8601.parse_datetime_as_naive(received_at_string)
-        except Exception as e:
-            print("[ERROR] Was unable to parse timestamp. Timestamp: %s. Error: %s" % (received_at_string, str(e)))
-            raise SystemExit
-        return received_at > start_time and received_at < end_time and record_generated_by != 'TMC' and payload_type != 'us.dot.its.jpo.ode.model.OdeBsmPayload'
-
-######
+    'query5_badOtherRecordCount': {
+        'where': [[('odeReceivedAt', '>', MONITORING_START), ('odeReceivedAt', '<', NON_TMC_BUG_FIX), ('recordGeneratedBy', '!=', 'TMC'), ('payloadType', '!=', BSM_PAYLOAD_TYPE)]],
+        'aggregate': ('count',),
+    },
 
     #############
     # Query Name:
@@ -104,34 +86,10 @@ class MetadataQueries:
     #   earliestGeneratedAt = SELECT MIN(metadata.recordGeneratedAt)
     # WHERE (metadata.odeReceivedAt >= 12/3/2018 AND metadata.odeReceivedAt <= 2/12/2019 AND metadata.recordGeneratedBy != TMC AND metadata.payloadType != us.dot.its.jpo.ode.model.OdeBsmPayload)
     # OR (metadata.odeReceivedAt >= 12/3/2018 AND metadata.odeReceivedAt < dateOfBugFix AND metadata.payloadType == us.dot.its.jpo.ode.model.OdeBsmPayload)
-    def query8_earliestGeneratedAt(self, record):
-        start_time = ciso8601.parse_datetime_as_naive('2018-12-03T00:00:00.000Z')
-        end_time_nontmc = ciso8601.parse_datetime_as_naive('2019-02-13T00:00:00.000Z')
-        end_time_full = ciso8601.parse_datetime_as_naive('2019-04-12T00:00:00.000Z')
-        record_object = json.loads(record)
-        received_at_string = record_object['metadata']['odeReceivedAt']
-        record_generated_by = record_object['metadata']['recordGeneratedBy']
-        record_generated_at_string = record_object['metadata']['recordGeneratedAt']
-        payload_type = record_object['metadata']['payloadType']
-        try:
-            received_at = ciso8601.parse_datetime_as_naive(received_at_string)
-            record_generated_at = ciso8601.parse_datetime_as_naive(record_generated_at_string)
-            if not hasattr(self, 'earliest_generated_at'):
-                self.earliest_generated_at = record_generated_at
-                print("Found first record_generated_at: %s" % self.earliest_generated_at)
-            else:
-                if received_at > start_time and received_at < end_time_nontmc and record_generated_by != 'TMC' and payload_type != 'us.dot.its.jpo.ode.model.OdeBsmPayload':
-                    if record_generated_at < self.earliest_generated_at:
-                        self.earliest_generated_at = record_generated_at
-                        print("Found new earliest_generated_at: %s" % self.earliest_generated_at)
-                elif received_at > start_time and received_at < end_time_full and payload_type == 'us.dot.its.jpo.ode.model.OdeBsmPayload':
-                    if record_generated_at < self.earliest_generated_at:
-                        self.earliest_generated_at = record_generated_at
-                        print("Found new earliest_generated_at: %s" % self.earliest_generated_at)
-        except Exception as e:
-            print("[ERROR] Was unable to parse timestamp. Timestamp: %s. Error: %s" % (received_at_string, str(e)))
-            raise SystemExit
-        return True
+    'query8_earliestGeneratedAt': {
+        'where': BUG_WINDOW,
+        'aggregate': ('min', 'recordGeneratedAt'),
+    },
 
     #############
     # Query Name:
@@ -140,34 +98,10 @@ class MetadataQueries:
     #   latestGeneratedAt = SELECT MAX(metadata.recordGeneratedAt)
     # WHERE (metadata.odeReceivedAt >= 12/3/2018 AND metadata.odeReceivedAt <= 2/12/2019 AND metadata.recordGeneratedBy != TMC AND metadata.payloadType != us.dot.its.jpo.ode.model.OdeBsmPayload)
     # OR (metadata.odeReceivedAt >= 12/3/2018 AND metadata.odeReceivedAt < dateOfBugFix AND metadata.payloadType == us.dot.its.jpo.ode.model.OdeBsmPayload)
-    def query9_latestGeneratedAt(self, record):
-        start_time = ciso8601.parse_datetime_as_naive('2018-12-03T00:00:00.000Z')
-        end_time_nontmc = ciso8601.parse_datetime_as_naive('2019-02-13T00:00:00.000Z')
-        end_time_full = ciso8601.parse_datetime_as_naive('2019-04-12T00:00:00.000Z')
-        record_object = json.loads(record)
-        received_at_string = record_object['metadata']['odeReceivedAt']
-        record_generated_by = record_object['metadata']['recordGeneratedBy']
-        record_generated_at_string = record_object['metadata']['recordGeneratedAt']
-        payload_type = record_object['metadata']['payloadType']
-        try:
-            received_at = ciso8601.parse_datetime_as_naive(received_at_string)
-            record_generated_at = ciso8601.parse_datetime_as_naive(record_generated_at_string)
-            if not hasattr(self, 'latest_generated_at'):
-                self.latest_generated_at = record_generated_at
-                print("Found last record_generated_at: %s" % self.latest_generated_at)
-            else:
-                if received_at > start_time and received_at < end_time_nontmc and record_generated_by != 'TMC' and payload_type != 'us.dot.its.jpo.ode.model.OdeBsmPayload':
-                    if record_generated_at > self.latest_generated_at:
-                        self.latest_generated_at = record_generated_at
-                        print("Found new latest_generated_at: %s" % self.latest_generated_at)
-                elif received_at > start_time and received_at < end_time_full and payload_type == 'us.dot.its.jpo.ode.model.OdeBsmPayload':
-                    if record_generated_at > self.latest_generated_at:
-                        self.latest_generated_at = record_generated_at
-                        print("Found new latest_generated_at: %s" % self.latest_generated_at)
-        except Exception as e:
-            print("[ERROR] Was unable to parse timestamp. Timestamp: %s. Error: %s" % (received_at_string, str(e)))
-            raise SystemExit
-        return True
+    'query9_latestGeneratedAt': {
+        'where': BUG_WINDOW,
+        'aggregate': ('max', 'recordGeneratedAt'),
+    },
 
     #############
     # Query Name:
@@ -176,26 +110,10 @@ class MetadataQueries:
     #   invalidS3FileCount = SELECT COUNT(s3-filename)
     # WHERE (metadata.odeReceivedAt >= 12/3/2018 AND metadata.odeReceivedAt <= 2/12/2019 AND metadata.recordGeneratedBy != TMC AND metadata.payloadType != us.dot.its.jpo.ode.model.OdeBsmPayload)
     # OR (metadata.odeReceivedAt >= 12/3/2018 AND metadata.odeReceivedAt < dateOfBugFix AND metadata.payloadType == us.dot.its.jpo.ode.model.OdeBsmPayload)
-    def query11_invalidS3FileCount(self, record):
-        start_time = ciso8601.parse_datetime_as_naive('2018-12-03T00:00:00.000Z')
-        end_time_nontmc = ciso8601.parse_datetime_as_naive('2019-02-13T00:00:00.000Z')
-        end_time_full = ciso8601.parse_datetime_as_naive('2019-04-12T00:00:00.000Z')
-        record_object = json.loads(record)
-        received_at_string = record_object['metadata']['odeReceivedAt']
-        record_generated_by = record_object['metadata']['recordGeneratedBy']
-        record_generated_at_string = record_object['metadata']['recordGeneratedAt']
-        payload_type = record_object['metadata']['payloadType']
-        try:
-            received_at = ciso8601.parse_datetime_as_naive(received_at_string)
-            record_generated_at = ciso8601.parse_datetime_as_naive(record_generated_at_string)
-            if received_at > start_time and received_at < end_time_nontmc and record_generated_by != 'TMC' and payload_type != 'us.dot.its.jpo.ode.model.OdeBsmPayload':
-                return True
-            elif received_at > start_time and received_at < end_time_full and payload_type == 'us.dot.its.jpo.ode.model.OdeBsmPayload':
-                return True
-        except Exception as e:
-            print("[ERROR] Was unable to parse timestamp. Timestamp: %s. Error: %s" % (received_at_string, str(e)))
-            raise SystemExit
-        return False
+    'query11_invalidS3FileCount': {
+        'where': BUG_WINDOW,
+        'aggregate': ('count',), # the invalid files are the query's satisfying files
+    },
 
     #############
     # Query Name:
@@ -204,33 +122,101 @@ class MetadataQueries:
     #   listOfLogFilesBefore = SELECT metadata.logFileName
     # WHERE (metadata.odeReceivedAt >= 12/3/2018 AND metadata.odeReceivedAt <= 2/12/2019 AND metadata.recordGeneratedBy != TMC AND metadata.payloadType != us.dot.its.jpo.ode.model.OdeBsmPayload)
     # OR (metadata.odeReceivedAt >= 12/3/2018 AND metadata.odeReceivedAt < dateOfBugFix AND metadata.payloadType == us.dot.its.jpo.ode.model.OdeBsmPayload)
-    def query13_listOfLogFilesBefore(self, record):
-        start_time = ciso8601.parse_datetime_as_naive('2018-12-03T00:00:00.000Z')
-        end_time_nontmc = ciso8601.parse_datetime_as_naive('2019-02-13T00:00:00.000Z')
-        end_time_full = ciso8601.parse_datetime_as_naive('2019-04-12T00:00:00.000Z')
-        record_object = json.loads(record)
-        received_at_string = record_object['metadata']['odeReceivedAt']
-        record_generated_by = record_object['metadata']['recordGeneratedBy']
-        record_generated_at_string = record_object['metadata']['recordGeneratedAt']
-        payload_type = record_object['metadata']['payloadType']
-        try:
-            received_at = ciso8601.parse_datetime_as_naive(received_at_string)
-            record_generated_at = ciso8601.parse_datetime_as_naive(record_generated_at_string)
-            if (received_at > start_time and received_at < end_time_nontmc and record_generated_by != 'TMC' and payload_type != 'us.dot.its.jpo.ode.model.OdeBsmPayload') or (received_at > start_time and received_at < end_time_full and payload_type == 'us.dot.its.jpo.ode.model.OdeBsmPayload'):
-                if not hasattr(self, 'log_file_list'):
-                    self.log_file_list = {}
-                if record_object['metadata'].get('logFileName') is None:
-                    if '_missing' not in self.log_file_list:
-                        self.log_file_list['_missing'] = 1
-                    else:
-                        self.log_file_list['_missing'] = self.log_file_list['_missing'] + 1
-                else:
-                    if record_object['metadata']['logFileName'] not in self.log_file_list:
-                        self.log_file_list[record_object['metadata']['logFileName']] = 1
-                    else:
-                        self.log_file_list[record_object['metadata']['logFileName']] = self.log_file_list[record_object['metadata']['logFileName']] + 1
-                return True
-        except Exception as e:
-            print("[ERROR] Was unable to parse timestamp. Timestamp: %s. Error: %s" % (received_at_string, str(e)))
-            raise SystemExit
-        return False
+    'query13_listOfLogFilesBefore': {
+        'where': BUG_WINDOW,
+        'aggregate': ('group_count', 'logFileName'),
+    },
+}
+
+COMPARISON_OPERATORS = ('==', '!=', '<', '<=', '>', '>=')
+
+AGGREGATES = {
+    'count': Count,
+    'min': Min,
+    'max': Max,
+    'distinct': DistinctSet,
+    'group_count': lambda: GroupCount(MISSING_GROUP_KEY),
+}
+
+### Parses an ODE timestamp string into a naive datetime, exiting on malformed timestamps
+def parse_timestamp(timestamp_string):
+    try:
+        return ciso8601.parse_datetime_as_naive(timestamp_string)
+    except Exception as e:
+        print("[ERROR] Was unable to parse timestamp. Timestamp: %s. Error: %s" % (timestamp_string, str(e)))
+        raise SystemExit
+
+### A query definition compiled once into a predicate over a row of extracted metadata fields (with
+### timestamps already parsed) and a factory for its aggregate.
+class CompiledQuery:
+    def __init__(self, name, definition):
+        self.name = name
+        self.clauses = []
+        for clause in definition.get('where', []):
+            conditions = []
+            for field, operator, value in clause:
+                if operator not in COMPARISON_OPERATORS:
+                    raise ValueError("Query '%s' uses unsupported operator '%s'" % (name, operator))
+                if field in TIMESTAMP_FIELDS:
+                    value = parse_timestamp(value)
+                conditions.append((field, operator, value))
+            self.clauses.append(conditions)
+        aggregate = definition.get('aggregate', ('count',))
+        if aggregate[0] not in AGGREGATES:
+            raise ValueError("Query '%s' uses unsupported aggregate '%s'" % (name, aggregate[0]))
+        self.aggregate_type = aggregate[0]
+        self.aggregate_field = aggregate[1] if len(aggregate) > 1 else None
+        self.fields = sorted(set([field for clause in self.clauses for field, _, _ in clause] + ([self.aggregate_field] if self.aggregate_field else [])))
+        self.predicate = self._compile_predicate()
+
+    ### Generates a single Python expression for the whole where clause, so evaluating a record costs
+    ### one function call with no per-condition dispatch. Constants are bound as names, never inlined.
+    def _compile_predicate(self):
+        if not self.clauses:
+            return lambda row: True
+        constants = {}
+        terms = []
+        for clause in self.clauses:
+            conditions = []
+            for field, operator, value in clause:
+                constant_name = '_c%d' % len(constants)
+                constants[constant_name] = value
+                conditions.append("row[%r] %s %s" % (field, operator, constant_name))
+            terms.append("(%s)" % " and ".join(conditions))
+        return eval("lambda row: %s" % " or ".join(terms), constants)
+
+    def new_aggregate(self):
+        return AGGREGATES[self.aggregate_type]()
+
+### Compiled set of metadata queries. Queries are stateless; running state lives in each query's
+### aggregate, which is held by whoever runs the queries.
+class MetadataQueries:
+    def __init__(self, definitions=QUERY_DEFINITIONS):
+        self.definitions = definitions
+        self.queries = {}
+        for name, definition in definitions.items():
+            self.queries[name] = CompiledQuery(name, definition)
+
+    # Compiled predicates cannot be pickled, so only the definitions are sent to worker processes
+    def __getstate__(self):
+        return {'definitions': self.definitions}
+
+    def __setstate__(self, state):
+        self.__init__(state['definitions'])
+
+    ### Returns the metadata fields the given queries need, split into (plain fields, timestamp fields)
+    def required_fields(self, query_names):
+        fields = set()
+        for name in query_names:
+            fields.update(self.queries[name].fields)
+        return sorted(fields - set(TIMESTAMP_FIELDS)), sorted(fields & set(TIMESTAMP_FIELDS))
+
+### Builds the row the compiled queries evaluate: the requested fields of a record's metadata block,
+### with timestamp fields parsed into datetimes
+def extract_row(metadata, fields, timestamp_fields):
+    row = {}
+    for field in fields:
+        row[field] = metadata.get(field)
+    for field in timestamp_fields:
+        row[field] = parse_timestamp(metadata.get(field))
+    return row
@@ -0,0 +1,59 @@
+### Reading ODE records as a stream. Sources are consumed through a fixed-size read buffer and
+### records are yielded one at a time, so memory use is bounded by the buffer size (plus the longest
+### single record) rather than by the size of the object being read. Compressed sources (see
+### compression.py) are decompressed as they are read; reads are counted after decompression.
+
+from compression import decompressing_stream
+
+READ_BUFFER_SIZE = 1024*1024
+
+### Yields the non-blank lines of a binary file-like object, reading at most buffer_size bytes at a time.
+### Reads are counted in metrics (a RunMetrics) if given.
+def iter_lines(stream, buffer_size=READ_BUFFER_SIZE, metrics=None):
+    read = stream.read if metrics is None else metrics.metered_read(stream)
+    partial = []
+    while True:
+        chunk = read(buffer_size)
+        if not chunk:
+            break
+        lines = chunk.split(b'\n')
+        if len(lines) == 1:
+            partial.append(chunk)
+            continue
+        if partial:
+            partial.append(lines[0])
+            lines[0] = b''.join(partial)
+            partial = []
+        if lines[-1]:
+            partial.append(lines[-1])
+        for i in range(len(lines) - 1):
+            line = lines[i]
+            if line and not line.isspace():
+                yield line
+    if partial:
+        line = b''.join(partial)
+        if not line.isspace():
+            yield line
+
+### Yields the records of a binary stream holding the contents of the file or object called name,
+### decompressing it first if it is compressed
+def iter_stream_records(stream, name, buffer_size=READ_BUFFER_SIZE, metrics=None):
+    records_stream = decompressing_stream(stream, name)
+    try:
+        yield from iter_lines(records_stream, buffer_size, metrics)
+    finally:
+        if records_stream is not stream:
+            records_stream.close()
+
+### Yields the records of a local file
+def iter_local_file_records(filename, buffer_size=READ_BUFFER_SIZE, metrics=None):
+    with open(filename, 'rb', buffering=0) as f:
+        yield from iter_stream_records(f, filename, buffer_size, metrics)
+
+### Yields the records of an S3 object, streaming its body rather than downloading it in full first
+def iter_s3_object_records(s3_client, bucket, key, buffer_size=READ_BUFFER_SIZE, metrics=None):
+    body = s3_client.get_object(Bucket=bucket, Key=key)['Body']
+    try:
+        yield from iter_stream_records(body, key, buffer_size, metrics)
+    finally:
+        body.close()
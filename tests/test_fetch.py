@@ -0,0 +1,208 @@
+import os
+import sys
+import tempfile
+import threading
+import time
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from botocore.exceptions import ClientError
+from botocore.response import StreamingBody
+from fetch import LocalS3Client, S3Prefetcher, _ByteBudget
+
+### Runs S3Prefetcher against LocalS3Client, checking ordering, the byte budget, streaming of objects
+### larger than the budget and clean shutdown on early close and failed downloads
+
+BUCKET = 'bucket'
+OBJECT_SIZES = [1000, 5000, 2000, 8000, 3000, 4000, 6000, 7000]
+
+### LocalS3Client that records its calls, the budget in use when each download was requested and
+### every file it opened
+class RecordingS3Client(LocalS3Client):
+    def __init__(self, root):
+        super().__init__(root)
+        self.lock = threading.Lock()
+        self.calls = []
+        self.in_flight_at_get = []
+        self.opened = []
+        self.budget = None
+
+    def head_object(self, Bucket, Key):
+        with self.lock:
+            self.calls.append(('head_object', Key))
+        return super().head_object(Bucket, Key)
+
+    def get_object(self, Bucket, Key):
+        path = self._path(Bucket, Key)
+        f = open(path, 'rb')
+        with self.lock:
+            self.calls.append(('get_object', Key))
+            self.opened.append(f)
+            if self.budget is not None:
+                self.in_flight_at_get.append(self.budget.in_flight)
+        size = os.path.getsize(path)
+        return {'Body': StreamingBody(f, size), 'ContentLength': size, 'ETag': self._etag(path)}
+
+### Runs function on a thread, failing the test if it does not finish within timeout seconds
+def run_with_timeout(test, function, timeout=10):
+    outcome = {}
+    def run():
+        try:
+            outcome['result'] = function()
+        except BaseException as e:
+            outcome['error'] = e
+    thread = threading.Thread(target=run, daemon=True)
+    thread.start()
+    thread.join(timeout)
+    test.assertFalse(thread.is_alive(), "timed out")
+    if 'error' in outcome:
+        raise outcome['error']
+    return outcome.get('result')
+
+def executor_threads():
+    return [thread for thread in threading.enumerate() if thread.name.startswith('ThreadPoolExecutor')]
+
+class S3PrefetcherTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.contents = {}
+        for number, size in enumerate(OBJECT_SIZES):
+            key = 'data/%02d.json' % number
+            self.contents[key] = bytes([ord('a') + number]) * size
+            path = os.path.join(self.directory.name, BUCKET, key)
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            with open(path, 'wb') as f:
+                f.write(self.contents[key])
+        self.keys = sorted(self.contents)
+        self.sizes = {key: len(data) for key, data in self.contents.items()}
+        self.client = RecordingS3Client(self.directory.name)
+        self.threads_before = len(executor_threads())
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def make_prefetcher(self, keys=None, max_in_flight_bytes=1024*1024, sizes=None, prefetch_count=4, concurrency=4):
+        prefetcher = S3Prefetcher(self.client, BUCKET, self.keys if keys is None else keys, prefetch_count, concurrency, max_in_flight_bytes, sizes)
+        self.client.budget = prefetcher.budget
+        return prefetcher
+
+    def assert_cleaned_up(self, prefetcher):
+        self.assertTrue(all(f.closed for f in self.client.opened), "a response body was left open")
+        self.assertEqual(prefetcher.budget.in_flight, 0)
+        self.assertEqual(len(executor_threads()), self.threads_before)
+
+    def test_yields_objects_in_order(self):
+        prefetcher = self.make_prefetcher(sizes=self.sizes)
+        received = run_with_timeout(self, lambda: [(key, stream.read()) for key, stream in prefetcher])
+        self.assertEqual(received, [(key, self.contents[key]) for key in self.keys])
+        self.assertNotIn('head_object', [call for call, _ in self.client.calls])
+        self.assert_cleaned_up(prefetcher)
+
+    def test_looks_up_unknown_sizes(self):
+        prefetcher = self.make_prefetcher(sizes={self.keys[0]: self.sizes[self.keys[0]]})
+        received = run_with_timeout(self, lambda: [(key, stream.read()) for key, stream in prefetcher])
+        self.assertEqual(received, [(key, self.contents[key]) for key in self.keys])
+        self.assertEqual(sorted(key for call, key in self.client.calls if call == 'head_object'), self.keys[1:])
+        for key in self.keys[1:]:
+            self.assertLess(self.client.calls.index(('head_object', key)), self.client.calls.index(('get_object', key)))
+
+    def test_budget_is_reserved_before_requesting(self):
+        max_in_flight_bytes = 10000
+        prefetcher = self.make_prefetcher(max_in_flight_bytes=max_in_flight_bytes, sizes=self.sizes, prefetch_count=8, concurrency=8)
+        def consume():
+            received = []
+            for key, stream in prefetcher:
+                time.sleep(0.01) # let downloads queue up behind the budget
+                received.append((key, stream.read()))
+            return received
+        received = run_with_timeout(self, consume)
+        self.assertEqual(received, [(key, self.contents[key]) for key in self.keys])
+        self.assertEqual(len(self.client.in_flight_at_get), len(self.keys))
+        # The in-flight count seen by each request already includes that request's own reservation
+        self.assertTrue(all(0 < in_flight <= max_in_flight_bytes for in_flight in self.client.in_flight_at_get), self.client.in_flight_at_get)
+        self.assert_cleaned_up(prefetcher)
+
+    def test_objects_larger_than_budget_are_streamed(self):
+        prefetcher = self.make_prefetcher(max_in_flight_bytes=4500, sizes=self.sizes)
+        def consume():
+            received = []
+            for key, stream in prefetcher:
+                received.append((key, isinstance(stream, StreamingBody), stream.read()))
+            return received
+        received = run_with_timeout(self, consume)
+        self.assertEqual([data for _, _, data in received], [self.contents[key] for key in self.keys])
+        self.assertEqual([streamed for _, streamed, _ in received], [self.sizes[key] > 4500 for key in self.keys])
+        self.assert_cleaned_up(prefetcher)
+
+    def test_closing_early_stops_downloads(self):
+        prefetcher = self.make_prefetcher(sizes=self.sizes, max_in_flight_bytes=12000)
+        def consume_one():
+            iterator = iter(prefetcher)
+            key, stream = next(iterator)
+            data = stream.read()
+            time.sleep(0.05) # let the prefetched downloads finish or wait on the budget
+            iterator.close()
+            return key, data
+        self.assertEqual(run_with_timeout(self, consume_one), (self.keys[0], self.contents[self.keys[0]]))
+        self.assertLess(len(self.client.in_flight_at_get), len(self.keys))
+        self.assert_cleaned_up(prefetcher)
+
+    def test_failed_download_is_raised_in_order(self):
+        keys = self.keys[:3] + ['data/missing.json'] + self.keys[3:]
+        sizes = dict(self.sizes)
+        sizes['data/missing.json'] = 100
+        prefetcher = self.make_prefetcher(keys=keys, sizes=sizes)
+        received = []
+        def consume():
+            for key, stream in prefetcher:
+                received.append((key, stream.read()))
+        with self.assertRaises(ClientError):
+            run_with_timeout(self, consume)
+        self.assertEqual(received, [(key, self.contents[key]) for key in self.keys[:3]])
+        self.assert_cleaned_up(prefetcher)
+
+class ByteBudgetTest(unittest.TestCase):
+    def test_reservations_are_granted_in_ticket_order(self):
+        budget = _ByteBudget(100)
+        granted = []
+        def acquire(ticket):
+            budget.acquire(ticket, 10)
+            granted.append(ticket)
+        later = threading.Thread(target=acquire, args=(1,))
+        later.start()
+        later.join(0.1)
+        self.assertTrue(later.is_alive(), "ticket 1 was granted before ticket 0")
+        acquire(0)
+        later.join(5)
+        self.assertEqual(granted, [0, 1])
+        self.assertEqual(budget.in_flight, 20)
+
+    def test_waits_for_released_bytes(self):
+        budget = _ByteBudget(100)
+        self.assertTrue(budget.acquire(0, 80))
+        waiting = threading.Thread(target=budget.acquire, args=(1, 50))
+        waiting.start()
+        waiting.join(0.1)
+        self.assertTrue(waiting.is_alive(), "reservation exceeding the budget was granted")
+        budget.release(80)
+        waiting.join(5)
+        self.assertFalse(waiting.is_alive())
+        self.assertEqual(budget.in_flight, 50)
+
+    def test_oversize_reservation_is_admitted_alone(self):
+        budget = _ByteBudget(100)
+        self.assertTrue(budget.acquire(0, 500))
+        self.assertEqual(budget.in_flight, 500)
+
+    def test_close_releases_waiters(self):
+        budget = _ByteBudget(100)
+        results = []
+        waiting = threading.Thread(target=lambda: results.append(budget.acquire(1, 10)))
+        waiting.start()
+        budget.close()
+        waiting.join(5)
+        self.assertEqual(results, [False])
+
+if __name__ == '__main__':
+    unittest.main()
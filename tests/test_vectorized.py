@@ -0,0 +1,56 @@
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import vectorized
+from engine import QueryEngine
+from queries import BSM_PAYLOAD_TYPE, MetadataQueries
+
+### Batched evaluation must agree with the row-at-a-time path, including on timestamps NumPy accepts
+### but the row path rejects
+
+BATCH_QUERIES = ['query1_totalRecordCount', 'query8_earliestGeneratedAt', 'query9_latestGeneratedAt']
+
+def bsm_metadata(received_at, generated_at):
+    return {'odeReceivedAt': received_at, 'recordGeneratedAt': generated_at, 'recordGeneratedBy': 'OBU', 'payloadType': BSM_PAYLOAD_TYPE, 'logFileName': 'a.csv'}
+
+def run_engine(metadata_list, batch_size):
+    engine = QueryEngine(MetadataQueries(), BATCH_QUERIES, batch_size)
+    engine.process_metadata(iter(metadata_list), 'file')
+    return engine.state_dict()
+
+@unittest.skipUnless(vectorized.available(), "numpy is not installed")
+class TimestampColumnTest(unittest.TestCase):
+    def test_plain_utc_timestamps_convert(self):
+        column = vectorized.timestamp_column(['2019-01-01T00:00:00.000Z', '2019-01-02T12:30:00.500Z'])
+        self.assertEqual(str(column.dtype), 'datetime64[us]')
+
+    def test_values_numpy_reads_as_nat_fall_back(self):
+        for value in ('', 'NaT', 'nat'):
+            self.assertIsNone(vectorized.timestamp_column(['2019-01-01T00:00:00.000Z', value]), value)
+
+    def test_missing_values_fall_back(self):
+        self.assertIsNone(vectorized.timestamp_column(['2019-01-01T00:00:00.000Z', None]))
+
+@unittest.skipUnless(vectorized.available(), "numpy is not installed")
+class BatchEvaluationTest(unittest.TestCase):
+    def test_batches_match_rows(self):
+        metadata_list = [bsm_metadata('2019-0%d-01T00:00:00.000Z' % month, '2019-0%d-02T00:00:00.000Z' % month) for month in range(1, 7)]
+        self.assertEqual(run_engine(metadata_list, 4), run_engine(metadata_list, 0))
+
+    def test_empty_generated_at_fails_like_rows(self):
+        metadata_list = [bsm_metadata('2019-01-01T00:00:00.000Z', '2019-01-02T00:00:00.000Z'), bsm_metadata('2019-01-01T00:00:00.000Z', '')]
+        with self.assertRaises(SystemExit):
+            run_engine(metadata_list, 0)
+        with self.assertRaises(SystemExit):
+            run_engine(metadata_list, 100)
+
+    def test_empty_received_at_fails_like_rows(self):
+        metadata_list = [bsm_metadata('', '2019-01-02T00:00:00.000Z')]
+        with self.assertRaises(SystemExit):
+            run_engine(metadata_list, 100)
+
+if __name__ == '__main__':
+    unittest.main()
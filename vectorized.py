@@ -0,0 +1,67 @@
+import warnings
+from queries import TIMESTAMP_FIELDS
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+### Batched (vectorized) query evaluation. The metadata fields of a chunk of records are gathered into
+### NumPy columns - timestamps as datetime64[us], everything else as object arrays - and each compiled
+### query's where clause is evaluated as array operations over the whole chunk, producing a boolean
+### mask. Aggregates are then updated once per chunk from the masked column. Requires numpy.
+
+def available():
+    return numpy is not None
+
+### Generates a mask expression for the query's where clause, mirroring CompiledQuery's row predicate.
+### Timestamp constants are converted to datetime64 once here.
+def compile_batch_predicate(query):
+    if not query.clauses:
+        return lambda columns, size: numpy.ones(size, dtype=bool)
+    constants = {}
+    terms = []
+    for clause in query.clauses:
+        conditions = []
+        for field, operator, value in clause:
+            constant_name = '_c%d' % len(constants)
+            constants[constant_name] = numpy.datetime64(value, 'us') if field in TIMESTAMP_FIELDS else value
+            conditions.append("(columns[%r] %s %s)" % (field, operator, constant_name))
+        terms.append("(%s)" % " & ".join(conditions))
+    return eval("lambda columns, size: %s" % " | ".join(terms), constants)
+
+### Converts ODE timestamp strings to a datetime64[us] array. Returns None if any value is missing or
+### not a plain UTC ('Z') timestamp, in which case the caller falls back to per-record parsing so
+### errors and unusual formats are handled exactly as in the row-at-a-time path. NumPy reads '' and
+### 'NaT' as NaT, which the row path rejects, so those fall back too.
+def timestamp_column(values):
+    if None in values:
+        return None
+    strings = numpy.array(values)
+    if strings.dtype.kind != 'U':
+        return None
+    try:
+        with warnings.catch_warnings():
+            warnings.simplefilter('error')
+            column = numpy.char.rstrip(strings, 'Z').astype('datetime64[us]')
+    except (ValueError, Warning):
+        return None
+    if numpy.isnat(column).any():
+        return None
+    return column
+
+### Converts {field: [value per record]} into {field: NumPy column}, or returns None if the batch has
+### to be evaluated row by row
+def build_columns(values_by_field, fields, timestamp_fields):
+    columns = {}
+    for field in timestamp_fields:
+        column = timestamp_column(values_by_field[field])
+        if column is None:
+            return None
+        columns[field] = column
+    for field in fields:
+        values = values_by_field[field]
+        column = numpy.empty(len(values), dtype=object)
+        column[:] = values
+        columns[field] = column
+    return columns
@@ -0,0 +1,184 @@
+import calendar
+import datetime
+import json
+import re
+from atomicwrite import write_atomically
+from queries import parse_timestamp
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+### Per-file summary statistics ("zone maps") used to avoid reading files that cannot affect a query.
+### A zone map records a file's record count, the range of its odeReceivedAt timestamps and the
+### distinct values of its low-cardinality metadata fields. Comparing a query's where clause against
+### a zone map tells whether none, some or all of the file's records can satisfy it.
+
+RANGE_FIELD = 'odeReceivedAt'
+DISTINCT_FIELDS = ('payloadType', 'recordGeneratedBy')
+
+MATCHES_NONE = 0
+MATCHES_SOME = 1
+MATCHES_ALL = 2
+
+### Builds the zone map of a file from the metadata dicts passing through collect(), or from columns
+class FileStatsCollector:
+    def __init__(self):
+        self.records = 0
+        self.range = None
+        self.distinct = {field: set() for field in DISTINCT_FIELDS}
+
+    def _update_range(self, timestamp_string):
+        timestamp = parse_timestamp(timestamp_string)
+        if self.range is None:
+            self.range = [timestamp, timestamp]
+        elif timestamp < self.range[0]:
+            self.range[0] = timestamp
+        elif timestamp > self.range[1]:
+            self.range[1] = timestamp
+
+    def collect(self, metadata_iterable):
+        distinct = list(self.distinct.items())
+        for metadata in metadata_iterable:
+            self.records += 1
+            self._update_range(metadata.get(RANGE_FIELD))
+            for field, values in distinct:
+                values.add(metadata.get(field))
+            yield metadata
+
+    def add_columns(self, columns, record_count):
+        self.records += record_count
+        for timestamp_string in columns[RANGE_FIELD]:
+            self._update_range(timestamp_string)
+        for field, values in self.distinct.items():
+            values.update(columns[field])
+
+    def stats(self):
+        return {'records': self.records, RANGE_FIELD: tuple(self.range) if self.range else None, **self.distinct}
+
+### Returns MATCHES_NONE, MATCHES_SOME or MATCHES_ALL for how a compiled query's where clause relates
+### to the records summarized by stats. Fields missing from stats are assumed to match some records.
+def classify(query, stats):
+    if stats.get('records') == 0:
+        return MATCHES_NONE
+    if not query.clauses:
+        return MATCHES_ALL
+    clause_matches = [_classify_clause(clause, stats) for clause in query.clauses]
+    if MATCHES_ALL in clause_matches:
+        return MATCHES_ALL
+    if all(match == MATCHES_NONE for match in clause_matches):
+        return MATCHES_NONE
+    return MATCHES_SOME
+
+def _classify_clause(clause, stats):
+    condition_matches = [_classify_condition(condition, stats) for condition in clause]
+    if MATCHES_NONE in condition_matches:
+        return MATCHES_NONE
+    if all(match == MATCHES_ALL for match in condition_matches):
+        return MATCHES_ALL
+    return MATCHES_SOME
+
+def _classify_condition(condition, stats):
+    field, operator, value = condition
+    if field == RANGE_FIELD and stats.get(RANGE_FIELD) is not None:
+        low, high = stats[RANGE_FIELD]
+        if operator == '>':
+            return MATCHES_ALL if low > value else MATCHES_NONE if high <= value else MATCHES_SOME
+        if operator == '>=':
+            return MATCHES_ALL if low >= value else MATCHES_NONE if high < value else MATCHES_SOME
+        if operator == '<':
+            return MATCHES_ALL if high < value else MATCHES_NONE if low >= value else MATCHES_SOME
+        if operator == '<=':
+            return MATCHES_ALL if high <= value else MATCHES_NONE if low > value else MATCHES_SOME
+        if operator == '==':
+            return MATCHES_NONE if value < low or value > high else MATCHES_ALL if low == high == value else MATCHES_SOME
+        if operator == '!=':
+            return MATCHES_ALL if value < low or value > high else MATCHES_NONE if low == high == value else MATCHES_SOME
+    if field in DISTINCT_FIELDS and stats.get(field) is not None:
+        values = stats[field]
+        if operator == '==':
+            return MATCHES_NONE if value not in values else MATCHES_ALL if values == {value} else MATCHES_SOME
+        if operator == '!=':
+            return MATCHES_ALL if value not in values else MATCHES_NONE if values == {value} else MATCHES_SOME
+    return MATCHES_SOME
+
+### Returns the [start, end) odeReceivedAt range implied by a prefix ending in the bucket's
+### YYYY/MM[/DD[/HH]] layout, widened by slack, or None if the prefix does not end in a (valid) date
+def prefix_time_range(prefix, slack=datetime.timedelta(0)):
+    match = re.search(r'(?:^|/)(\d{4})/(\d{2})(?:/(\d{2}))?(?:/(\d{2}))?/?$', prefix)
+    if match is None:
+        return None
+    year, month = int(match.group(1)), int(match.group(2))
+    try:
+        if match.group(4):
+            start = datetime.datetime(year, month, int(match.group(3)), int(match.group(4)))
+            end = start + datetime.timedelta(hours=1)
+        elif match.group(3):
+            start = datetime.datetime(year, month, int(match.group(3)))
+            end = start + datetime.timedelta(days=1)
+        else:
+            start = datetime.datetime(year, month, 1)
+            end = start + datetime.timedelta(days=calendar.monthrange(year, month)[1])
+        return start - slack, end + slack
+    except (ValueError, OverflowError): # e.g. 2019/13 or 2019/02/30
+        return None
+
+### Returns False if no record under prefix can satisfy any of the given compiled queries, judged only
+### from the date in the prefix
+def prefix_may_match(prefix, queries, slack=datetime.timedelta(0)):
+    time_range = prefix_time_range(prefix, slack)
+    if time_range is None:
+        return True
+    stats = {RANGE_FIELD: time_range}
+    return any(classify(query, stats) != MATCHES_NONE for query in queries)
+
+### Zone maps of many files, persisted as a JSON file keyed by object key. Each entry stores the object
+### version it was computed from and is ignored once the object changes.
+class ZoneMapIndex:
+    def __init__(self, path):
+        self.path = path
+        self.entries = self._load()
+        self.updates = {}
+
+    def _load(self):
+        try:
+            with open(self.path, 'r') as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return {}
+
+    ### Returns the zone map for the given object version, or None if there is none
+    def get(self, key, version):
+        entry = self.entries.get(key)
+        if entry is None or entry['version'] != version:
+            return None
+        stats = {'records': entry['records'], RANGE_FIELD: None}
+        if entry[RANGE_FIELD] is not None:
+            stats[RANGE_FIELD] = tuple(datetime.datetime.fromisoformat(timestamp) for timestamp in entry[RANGE_FIELD])
+        for field in DISTINCT_FIELDS:
+            stats[field] = set(entry[field])
+        return stats
+
+    def put(self, key, version, stats):
+        entry = {'version': version, 'records': stats['records'], RANGE_FIELD: None}
+        if stats[RANGE_FIELD] is not None:
+            entry[RANGE_FIELD] = [timestamp.isoformat() for timestamp in stats[RANGE_FIELD]]
+        for field in DISTINCT_FIELDS:
+            entry[field] = sorted(stats[field], key=lambda value: (value is not None, value))
+        self.entries[key] = entry
+        self.updates[key] = entry
+
+    ### Writes new entries to disk. The file is re-read and merged under a lock first, so processes
+    ### sharing the index do not overwrite each other's entries.
+    def save(self):
+        if not self.updates:
+            return
+        with open(self.path + '.lock', 'w') as lock_file:
+            if fcntl is not None:
+                fcntl.flock(lock_file, fcntl.LOCK_EX)
+            entries = self._load()
+            entries.update(self.updates)
+            write_atomically(self.path, json.dumps(entries, separators=(',', ':')))
+        self.entries = entries
+        self.updates = {}